@@ -5,16 +5,19 @@ import inspect
 import logging
 from datetime import datetime
 from functools import wraps
-from typing import Callable, Dict, List, Union, Optional
+from typing import Callable, Dict, List, Tuple, Union, Optional
 from uuid import UUID
 
 import redis
+import redis.asyncio
 from marshmallow import Schema, ValidationError
 
 from .admin import admin
+from .aio import AsyncMultiGroupConsumer, async_link
 from .com import Message
 from .config import staging
-from .consumer import MultiConsumer, ThreadedMultiConsumer
+from .consumer import BatchProcessor, MultiConsumer, ThreadedMultiConsumer
+from .validation import Validator
 
 __version__ = "1.1.3"
 
@@ -30,6 +33,16 @@ def stage(topic: str, data: Dict[str, Union[int, str, datetime, UUID]], delay: O
     return e.msg_uid
 
 
+# Same as `stage` for many messages at once, pairs of topic and data, which are inserted with multi row INSERTs
+def stage_many(messages: List[Tuple[str, Dict[str, Union[int, str, datetime, UUID]]]], delay: Optional[int] = None) -> List[UUID]:
+    return staging.repository.create_many(list(messages), delay=delay or 0)
+
+
+# Deletes the staged messages that have been sent more than `older_than` seconds ago, see `StagedMessage.purge_sent`
+def purge_sent(older_than: float, chunk_size: int = 1000, archive: Optional[Callable] = None) -> int:
+    return staging.repository.purge_sent(older_than, chunk_size=chunk_size, archive=archive)
+
+
 def staged() -> List[Message]:
     return [e.to_telstar() for e in staging.repository.unsent()]
 
@@ -42,6 +55,7 @@ class app:
         self.consumer_cls: MultiConsumer = consumer_cls
         self.kwargs = kwargs
         self.error_handlers = {}
+        self.validators: Dict[str, Validator] = {}
 
     def _register_error_handler(self, exc_class, fn):
         self.error_handlers[exc_class] = fn
@@ -60,14 +74,38 @@ class app:
     def run_once(self) -> None:
         self.get_consumer().run_once()
 
+    # Consumers for the asyncio engine, `link` defaults to an asyncio client for the server of `self.link`.
+    # `kw` are passed on to the consumers in addition to the options given to the app, e.g. `max_in_flight`.
+    def get_async_consumer(self, link: Optional[redis.asyncio.Redis] = None, **kw) -> AsyncMultiGroupConsumer:
+        return AsyncMultiGroupConsumer(link or async_link(self.link), self.consumer_name, self.config,
+                                       error_handlers=self.error_handlers, **{**self.kwargs, **kw})
+
+    async def start_async(self, link: Optional[redis.asyncio.Redis] = None, **kw) -> None:
+        await self.get_async_consumer(link, **kw).run()
+
+    async def run_once_async(self, link: Optional[redis.asyncio.Redis] = None, **kw) -> None:
+        await self.get_async_consumer(link, **kw).run_once()
+
     def requires_full_message(self, fn: Callable) -> bool:
         argsspec = inspect.getfullargspec(fn)
         arg = argsspec.args[0]
         return argsspec.annotations[arg] is Message
 
+    def requires_full_messages(self, fn: Callable) -> bool:
+        argsspec = inspect.getfullargspec(fn)
+        arg = argsspec.args[0]
+        return argsspec.annotations.get(arg) == List[Message]
+
+    # Validation stats of the consumers by `group.handler`, see `Validator.stats`.
+    # Consumers that run in other processes keep their stats to themselves.
+    def metrics(self) -> dict:
+        return dict(validation={name: validator.stats() for name, validator in self.validators.items()})
+
+    # `schema` can be a class or an instance, there is one instance per consumer which is reused for every message
     def consumer(self, group: str, streams: list, schema: Schema, strict=True, acknowledge_invalid=False) -> Callable:
         def decorator(fn):
             fullmessage = self.requires_full_message(fn)
+            validator = self.validators[f"{group}.{fn.__name__}"] = Validator(schema)
             nonlocal streams
             if not isinstance(streams, list):
                 streams = [streams]
@@ -75,7 +113,7 @@ class app:
                 @wraps(fn)
                 def actual_consumer(consumer: MultiConsumer, msg: Message, done: callable):
                     try:
-                        msg.data = schema().load(msg.data)
+                        msg.data = validator.load(msg.data)
                         fn(msg) if fullmessage else fn(msg.data)
                         done()
                     except ValidationError as err:
@@ -85,10 +123,78 @@ class app:
                         if strict:
                             raise err
 
-                if group in self.config:
-                    self.config[group][stream] = actual_consumer
-                else:
-                    self.config[group] = {stream: actual_consumer}
+                if inspect.iscoroutinefunction(fn):
+                    actual_consumer = self._async_consumer(fn, fullmessage, validator, strict, acknowledge_invalid)
+
+                self._register(group, stream, actual_consumer)
             return fn
 
         return decorator
+
+    # Like `consumer` but `fn` is handed a list of up to `max_batch` records, or messages if annotated with `List[Message]`.
+    # A batch is handed over once it is full or its first message has been waiting for `max_wait_ms`, see `BatchProcessor`.
+    # `fn` returns whether each record has been processed, or `None` if all of them have. Only the successful ones are
+    # acknowledged, the others remain pending and are retried. Invalid messages are not handed to `fn` at all,
+    # they are acknowledged with `acknowledge_invalid` and remain pending otherwise.
+    def batch_consumer(self, group: str, streams: list, schema: Schema, max_batch: int = 100, max_wait_ms: int = 0,
+                       acknowledge_invalid=False) -> Callable:
+        def decorator(fn):
+            fullmessages = self.requires_full_messages(fn)
+            validator = self.validators[f"{group}.{fn.__name__}"] = Validator(schema)
+
+            @wraps(fn)
+            def actual_consumer(consumer: MultiConsumer, msgs: List[Message]) -> List[bool]:
+                succeeded = [acknowledge_invalid] * len(msgs)
+                decoded = list()
+                for index, msg in enumerate(msgs):
+                    try:
+                        decoded.append((index, msg.data))
+                    except ValueError:
+                        log.error(f"Unable to decode message: {msg.msg_uuid}", exc_info=True)
+                loaded, errors = validator.load_many([data for _, data in decoded])
+                valid = list()
+                for (index, _), data, position in zip(decoded, loaded, range(len(decoded))):
+                    if position in errors:
+                        log.error(f"Unable to validate message: {msgs[index]} {errors[position]}")
+                        continue
+                    msgs[index].data = data
+                    valid.append(index)
+                if not valid:
+                    return succeeded
+                results = fn([msgs[index] for index in valid] if fullmessages else [msgs[index].data for index in valid])
+                if results is None:
+                    results = [True] * len(valid)
+                if len(results) != len(valid):
+                    raise ValueError(f"{fn.__name__} returned {len(results)} result(s) for {len(valid)} record(s)")
+                for index, success in zip(valid, results):
+                    succeeded[index] = bool(success)
+                return succeeded
+
+            processor = BatchProcessor(actual_consumer, max_batch=max_batch, max_wait_ms=max_wait_ms)
+            for stream in (streams if isinstance(streams, list) else [streams]):
+                self._register(group, stream, processor)
+            return fn
+
+        return decorator
+
+    def _register(self, group: str, stream: str, processor: Callable) -> None:
+        if group in self.config:
+            self.config[group][stream] = processor
+        else:
+            self.config[group] = {stream: processor}
+
+    # Same as the consumer in `consumer` but for coroutines, which can only be run with `start_async`
+    def _async_consumer(self, fn: Callable, fullmessage: bool, validator: Validator, strict: bool, acknowledge_invalid: bool) -> Callable:
+        @wraps(fn)
+        async def actual_consumer(consumer: MultiConsumer, msg: Message, done: Callable):
+            try:
+                msg.data = validator.load(msg.data)
+                await (fn(msg) if fullmessage else fn(msg.data))
+                await done()
+            except ValidationError as err:
+                log.error(f"Unable to validate message: {msg}", exc_info=True)
+                if acknowledge_invalid:
+                    await done()
+                if strict:
+                    raise err
+        return actual_consumer
@@ -1,10 +1,8 @@
-import json
-import uuid
 from typing import Dict, List, Optional, Tuple, Union
 
 import redis
 
-from .com import Message, decrement_msg_id
+from .com import Message, StreamID
 
 
 class admin:
@@ -48,13 +46,15 @@ class Group:
         self.stream = stream
         self.link = stream.link
         self.name = name
-        self.pending, self.min, self.max, self.consumers = pending, min, max, consumers
+        self.pending, self.consumers = pending, consumers
+        self.min: Optional[StreamID] = StreamID.parse(min) if min is not None else None
+        self.max: Optional[StreamID] = StreamID.parse(max) if max is not None else None
 
     def get_pending_messages(self) -> List["AdminMessage"]:
         if self.pending == 0:
             return []
         return [AdminMessage(self, **info)
-                for info in self.link.xpending_range(self.stream.name, self.name, self.min, self.max, self.pending)]
+                for info in self.link.xpending_range(self.stream.name, self.name, bytes(self.min), bytes(self.max), self.pending)]
 
     def get_consumers(self) -> List["Consumer"]:
         return [Consumer(self, **info) for info in self.link.xinfo_consumers(self.stream.name, self.name)]
@@ -82,26 +82,24 @@ class Consumer:
 class AdminMessage:
     def __init__(self, group: Group, message_id: bytes, consumer: str, time_since_delivered: int, times_delivered: int) -> None:
         self.group = group
-        self.message_id = message_id
+        self.message_id = StreamID.parse(message_id)
         self.consumer = consumer
         self.time_since_delivered = time_since_delivered
         self.times_delivered = times_delivered
 
     def remove(self):
         pipe = self.group.stream.admin.link.pipeline()
-        pipe.xack(self.group.stream.name, self.group.name, self.message_id)
-        pipe.xdel(self.group.stream.name, self.message_id)
+        pipe.xack(self.group.stream.name, self.group.name, bytes(self.message_id))
+        pipe.xdel(self.group.stream.name, bytes(self.message_id))
         pipe.execute()
 
     def read_raw(self) -> List[List[Union[bytes, List[Tuple[bytes, Dict[bytes, bytes]]]]]]:
         return self.group.stream.admin.link.xread({
-            self.group.stream.name: decrement_msg_id(self.message_id)
+            self.group.stream.name: bytes(self.message_id.previous())
         }, count=1)
 
     def read(self) -> Message:
         for stream_name, records in self.read_raw():
             for record in records:
                 stream_msg_id, record = record
-                return Message(stream_name,
-                               uuid.UUID(record[Message.IDFieldName].decode("ascii")),
-                               json.loads(record[Message.DataFieldName]))
+                return Message.from_record(stream_name, record)
@@ -0,0 +1,314 @@
+import asyncio
+import inspect
+import logging
+import time
+from functools import partial
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple, Union
+
+import redis
+import redis.asyncio
+import redis.asyncio.connection
+import redis.connection
+
+from .com import Message, StreamID
+from .consumer import BatchProcessor, BatchProgress, MultiConsumer
+
+# The consumer of `telstar.consumer` on top of `redis.asyncio` (redis-py >= 4.2), many consumer groups
+# share a single event loop instead of a thread each and a group can have several messages in flight.
+# Processors are coroutines `async def fn(consumer, msg, done)` which `await done()` to acknowledge a message.
+# The semantics are the same as with the threaded consumer, the checkpoints, seen store and seen cache are shared
+# with it as well - only the round trips to redis are awaited.
+
+log = logging.getLogger(__name__)
+
+
+# The asyncio counterparts of the connections of the blocking client
+ASYNC_CONNECTIONS = {
+    redis.connection.Connection: redis.asyncio.connection.Connection,
+    redis.connection.SSLConnection: redis.asyncio.connection.SSLConnection,
+    redis.connection.UnixDomainSocketConnection: redis.asyncio.connection.UnixDomainSocketConnection,
+}
+
+# Options of the blocking client that hold objects of its own, the asyncio connections create theirs
+BLOCKING_ONLY_OPTIONS = ("retry", "redis_connect_func", "maint_notifications_pool_handler")
+
+
+def _connection_options(connection_class: type) -> Set[str]:
+    options = set()
+    for cls in connection_class.__mro__:
+        if "__init__" in vars(cls):
+            options.update(name for name, param in inspect.signature(cls.__init__).parameters.items()
+                           if param.kind in (param.KEYWORD_ONLY, param.POSITIONAL_OR_KEYWORD))
+    return options
+
+
+# Creates an asyncio client for the same server the given (blocking) client talks to, be it over TCP, TLS or a
+# unix socket. Clients with connections of their own have to be given an asyncio client explicitly.
+def async_link(link: redis.Redis) -> redis.asyncio.Redis:
+    pool = link.connection_pool
+    connection_class = next((ASYNC_CONNECTIONS[cls] for cls in pool.connection_class.__mro__ if cls in ASYNC_CONNECTIONS), None)
+    if connection_class is None:
+        raise ValueError(f"Can't derive an asyncio client from {pool.connection_class.__name__}, pass a redis.asyncio.Redis instead")
+    options = _connection_options(connection_class)
+    kwargs = {name: value for name, value in pool.connection_kwargs.items()
+              if name in options and name not in BLOCKING_ONLY_OPTIONS}
+    return redis.asyncio.Redis(connection_pool=redis.asyncio.ConnectionPool(connection_class=connection_class, **kwargs))
+
+
+class AsyncMultiConsumer(MultiConsumer):
+    _awaits_processors = True
+
+    # `max_in_flight` is the number of messages of this group that are processed concurrently, with more than one
+    # the messages of a batch are no longer processed in the order they were sent in. Just like with the thread pool
+    # of `MultiConsumer` the checkpoint only moves up to the last message all of whose predecessors are acknowledged.
+    # The options `batch_ack`, `atomic_ack`, `autoclaim`, `process_claimed`, `max_workers`, `prefetch` and `checkpoint_interval` as well as batch processors are not supported (yet).
+    def __init__(self, link: redis.asyncio.Redis, group_name: str, consumer_name: str, config: dict, max_in_flight: int = 1, **kw) -> None:
+        unsupported = [option for option in ("batch_ack", "atomic_ack", "autoclaim", "process_claimed", "prefetch") if kw.get(option)]
+        if kw.get("checkpoint_interval") is not None:
+            unsupported.append("checkpoint_interval")
+        if kw.get("max_workers", 1) > 1:
+            unsupported.append("max_workers, use max_in_flight")
+        if any(isinstance(fn, BatchProcessor) for fn in config.values()):
+            unsupported.append("batch processors")
+        if unsupported:
+            raise ValueError(f"{self.__class__.__name__} does not support: {', '.join(unsupported)}")
+        super().__init__(link, group_name, consumer_name, config, **kw)
+        self.max_in_flight = max_in_flight
+        self._groups_created = False
+
+    # The consumer groups are created with the first `run_once` as we can't await them here
+    def _create_consumer_groups(self) -> None:
+        pass
+
+    async def create_consumer_groups(self) -> None:
+        if self._groups_created:
+            return
+        for stream_name in self.streams:
+            try:
+                await self.link.xgroup_create(stream_name, self.group_name, mkstream=True, id="0")
+            except redis.exceptions.ResponseError:
+                log.debug(f"Group: {self.group_name} for Stream: '{stream_name}' already exists")
+        self._groups_created = True
+
+    async def claim_message_from_the_dead(self, stream_name: str) -> Optional[List[StreamID]]:
+        pending_info = await self.link.xpending(stream_name, self.group_name)
+        if pending_info["pending"] == 0:
+            log.debug(f"Stream: '{stream_name}' in Group: '{self.group_name}' has no pending messages")
+            return
+        pending_messages = await self.link.xpending_range(stream_name, self.group_name,
+                                                          pending_info["min"], pending_info["max"], pending_info["pending"])
+        messages_to_claim = [p["message_id"] for p in pending_messages]
+        if not messages_to_claim:
+            return
+        log.debug(f"Stream: '{stream_name}' in Group: '{self.group_name}' claiming: {len(messages_to_claim)} message(s)")
+        return StreamID.parse_many(await self.link.xclaim(stream_name, self.group_name, self.consumer_name, self.claim_the_dead_after,
+                                                          messages_to_claim, justid=True))
+
+    # See `MultiConsumer.transfer_and_process_stream_history`
+    async def transfer_and_process_stream_history(self, streams: list) -> None:
+        last_seen = dict()
+        for stream_name in streams:
+            last_seen[stream_name] = await self.get_last_seen_id(stream_name)
+            stream_msg_ids = await self.claim_message_from_the_dead(stream_name)
+            if stream_msg_ids:
+                before_earliest = min(stream_msg_ids).previous()
+                next_after_seen = last_seen[stream_name].next()
+                last_seen[stream_name] = min([before_earliest, next_after_seen])
+        log.info(f"Stream: '{', '.join(last_seen)}' in Group: '{self.group_name}' as Consumer: '{self.consumer_name}' reading past messages")
+        await self.catchup({stream_name: bytes(stream_msg_id) for stream_name, stream_msg_id in last_seen.items()})
+
+    async def run(self) -> None:
+        log.info(f"Starting consumer loop for Group {self.group_name}")
+        while True:
+            await self.run_once()
+
+    async def run_once(self) -> None:
+        await self.create_consumer_groups()
+        if self.claim_is_due():
+            await self.transfer_and_process_stream_history(self.streams)
+            self._last_claim = time.monotonic()
+        config = {k: ">" for k in self.streams}
+        log.info(f"Stream: '{', '.join(self.streams)}' in Group: '{self.group_name}' as Consumer: '{self.consumer_name}' reading pending message or waiting for new")
+        await self.read(config, block=self.block)
+
+    async def get_last_seen_id(self, stream_name: str) -> StreamID:
+        if stream_name not in self._checkpoints:
+            self._checkpoints[stream_name] = StreamID.parse(await self.link.get(self._checkpoint_key(stream_name)) or b"0-0")
+        return self._checkpoints[stream_name]
+
+    async def acknowledge(self, msg: Message, stream_msg_id: Union[StreamID, bytes, str], duplicate: bool = False) -> None:
+        stream_msg_id = StreamID.parse(stream_msg_id)
+        self._batch_acked.add((msg.stream, str(msg.msg_uuid)))
+        log.debug(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' acknowledging Message: {msg.msg_uuid} - {stream_msg_id}")
+        async with self.link.pipeline() as pipe:
+            watch_keys = self._ack_watch_keys(msg)
+            if watch_keys:
+                await pipe.watch(*watch_keys)
+            self._queue_acknowledge(pipe, msg, stream_msg_id)
+            await pipe.execute()
+        self._acknowledged(f"telstar:stream:{msg.stream}", stream_msg_id)
+        self._remember_seen([(msg.stream, str(msg.msg_uuid))])
+
+    async def work(self, stream_name: bytes, stream_msg_id: StreamID, record: Dict[bytes, bytes], seen: Optional[bool] = None) -> None:
+        msg = self._message(stream_name, record)
+        done = partial(self.acknowledge, msg, stream_msg_id)
+        if seen is None:
+            [seen] = await self._seen_records([(msg.stream, str(msg.msg_uuid))])
+        if seen:
+            log.debug(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' skipping already processed Message: {msg.msg_uuid} - {stream_msg_id} ")
+            return await done(duplicate=True)
+
+        log.info(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' processing Message: {msg.msg_uuid} - {stream_msg_id}")
+        await self.processors[stream_name.decode("ascii")](self, msg, done)
+
+    # Writes the checkpoints a concurrently processed batch has moved forward, see `MultiConsumer._save_checkpoints`
+    async def _store_checkpoints(self, checkpoints: Dict[str, StreamID]) -> None:
+        checkpoints = {stream_name: stream_msg_id for stream_name, stream_msg_id in checkpoints.items()
+                       if stream_name not in self._checkpoints or stream_msg_id > self._checkpoints[stream_name]}
+        if not checkpoints:
+            return
+        async with self.link.pipeline(transaction=False) as pipe:
+            for stream_name, stream_msg_id in checkpoints.items():
+                pipe.set(self._checkpoint_key(stream_name), bytes(stream_msg_id))
+            await pipe.execute()
+        for stream_name, stream_msg_id in checkpoints.items():
+            self._remember_checkpoint(stream_name, stream_msg_id)
+
+    async def catchup(self, streams: Dict[str, bytes]) -> int:
+        processed = 0
+        async for page in self._pages(streams, self.catchup_page_size):
+            processed += await self._process(page)
+        return processed
+
+    async def read(self, streams: Dict[str, str], block: int) -> int:
+        return await self._process(await self.link.xreadgroup(self.group_name, self.consumer_name, streams, block=block))
+
+    # See `MultiConsumer._pages`
+    async def _pages(self, streams: Dict[str, bytes], count: Optional[int]) -> AsyncIterator[list]:
+        streams = dict(streams)
+        while streams:
+            page = await self.link.xreadgroup(self.group_name, self.consumer_name, streams, count=count)
+            yield page
+            if count is None:
+                return
+            next_streams = dict()
+            for stream_name, records in page:
+                if len(records) < count:
+                    continue
+                if isinstance(stream_name, bytes):
+                    stream_name = stream_name.decode("ascii")
+                start = streams.get(stream_name)
+                next_streams[stream_name] = start if start in (">", b">") else records[-1][0]
+            streams = next_streams
+
+    async def _process(self, response: list) -> int:
+        result = list(self._records(response))
+        if not result:
+            return 0
+        self.processed += len(result)
+        messages = [self._record_seen(stream_name, record) for stream_name, _, record in result]
+        seen = await self._seen_records(messages)
+        # The checkpoint must not move past messages that are still in flight
+        progress = self._progress = BatchProgress(response) if self.max_in_flight > 1 else None
+        try:
+            return await self._process_records(result, messages, seen)
+        finally:
+            if progress is not None:
+                self._progress = None
+                await self._store_checkpoints(progress.checkpoints())
+
+    async def _process_records(self, result: List[Tuple[bytes, StreamID, Dict[bytes, bytes]]], messages: List[Optional[Tuple[str, str]]], seen: List[bool]) -> int:
+        await self._acknowledge_seen([t for t, is_seen in zip(result, seen) if is_seen])
+        self._batch_acked = set()
+
+        # Only the first of several double sends within the batch is processed concurrently with the others,
+        # the rest has to wait until we know whether it has been acknowledged.
+        first, again, dispatched = list(), list(), set()
+        for t, message, is_seen in zip(result, messages, seen):
+            if is_seen:
+                continue
+            if message is not None and message in dispatched:
+                again.append((t, message))
+                continue
+            dispatched.add(message)
+            first.append((t, message))
+
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def dispatch(t: Tuple[bytes, StreamID, Dict[bytes, bytes]], message: Optional[Tuple[str, str]]) -> None:
+            async with semaphore:
+                stream_name, stream_msg_id, record = t
+                try:
+                    await self.work(stream_name, stream_msg_id, record, seen=message in self._batch_acked)
+                except Exception as exc:
+                    await self._handle_exception(exc, stream_name, stream_msg_id, record)
+
+        if self.max_in_flight > 1:
+            errors = [error for error in await asyncio.gather(*(dispatch(*m) for m in first), return_exceptions=True)
+                      if error is not None]
+            if errors:
+                raise errors[0]
+        else:
+            for m in first:
+                await dispatch(*m)
+        for m in again:
+            await dispatch(*m)
+        return len(result)
+
+    async def _seen_records(self, messages: List[Optional[Tuple[str, str]]]) -> List[bool]:
+        lookup, cached = self._split_cached(messages)
+        seen = dict.fromkeys(cached, True)
+        if lookup:
+            pipe = self.link.pipeline(transaction=False)
+            found = self.seen_store.lookup(pipe, self.group_name, lookup)
+            seen.update(zip(lookup, found(await pipe.execute())))
+        return [bool(seen.get(message)) for message in messages]
+
+    async def _acknowledge_seen(self, records: List[Tuple[bytes, StreamID, Dict[bytes, bytes]]]) -> None:
+        if not records:
+            return
+        async with self.link.pipeline() as pipe:
+            checkpoints, seen = self._queue_acknowledge_seen(pipe, records)
+            await pipe.execute()
+        self._remember_acknowledged_seen(checkpoints, seen)
+
+    # Error handlers can be coroutines as well, those have to `await ack()`
+    async def _handle_exception(self, exc, stream_name, stream_msg_id, record):
+        handler = self._find_error_handler(exc)
+
+        if handler is None:
+            raise exc
+
+        bare_ack = partial(self._bare_ack, stream_name, stream_msg_id)
+        result = handler(exc, bare_ack, record)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _bare_ack(self, stream_name, stream_msg_id):
+        if isinstance(stream_name, bytes):
+            stream_name = stream_name.decode("ascii")
+        stream_msg_id = StreamID.parse(stream_msg_id)
+        async with self.link.pipeline() as pipe:
+            if self._write_checkpoints and self._moves_checkpoint(stream_name, stream_msg_id):
+                pipe.set(self._checkpoint_key(stream_name), bytes(stream_msg_id))
+            pipe.xack(stream_name, self.group_name, bytes(stream_msg_id))
+            await pipe.execute()
+        self._acknowledged(stream_name, stream_msg_id)
+
+
+# Runs a consumer for each group on the current event loop, the counterpart to `ThreadedMultiConsumer`
+class AsyncMultiGroupConsumer:
+    def __init__(self, link: redis.asyncio.Redis, consumer_name: str, group_configs: dict, **kw) -> None:
+        self.consumers = list()
+        for group_name, config in group_configs.items():
+            self.consumers.append(AsyncMultiConsumer(link, group_name, consumer_name, config, **kw))
+
+    async def run(self) -> None:
+        await self._gather("run")
+
+    async def run_once(self) -> None:
+        await self._gather("run_once")
+
+    async def _gather(self, target: str) -> None:
+        await asyncio.gather(*(getattr(c, target)() for c in self.consumers))
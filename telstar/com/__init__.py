@@ -1,60 +1,133 @@
-import json
 import uuid
-from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from . import codecs
+from .codecs import Codec, TelstarEncoder  # noqa
 
 
 class MessageError(Exception):
     pass
 
 
-class TelstarEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime):
-            return o.isoformat()
-
-        if isinstance(o, uuid.UUID):
-            return str(o)
-
-        return json.JSONEncoder.default(self, o)
-
-
 class Message(object):
     IDFieldName = b"message_id"
     DataFieldName = b"data"
+    ContentTypeFieldName = b"content_type"
+    # Who sent the message and its position among all messages of that producer, see `Producer`
+    ProducerFieldName = b"producer"
+    SequenceFieldName = b"sequence"
+
+    # Messages read from a stream keep the raw fields of their record and only decode them on first access,
+    # a message that turns out to be a double send or is only passed on is never decoded.
+    __slots__ = ("stream", "_msg_uuid", "_data", "_raw_uuid", "_raw", "_content_type")
 
     def __init__(self, stream: str, msg_uuid: uuid.UUID, data: dict) -> None:
         if not isinstance(msg_uuid, uuid.UUID):
             raise TypeError(f"msg_uuid needs to be uuid.UUID not {type(msg_uuid)}")
-        if isinstance(stream, bytes):
-            stream = stream.decode("ascii")
-        self.stream = stream.replace("telstar:stream:", "")
-        self.msg_uuid = msg_uuid
-        self.data = data
+        self.stream = _stream(stream)
+        self._msg_uuid = msg_uuid
+        self._data = data
+        self._raw_uuid = None
+        self._raw = None
+        self._content_type = None
+
+    @classmethod
+    def from_record(cls, stream: Union[bytes, str], record: Dict[bytes, bytes]) -> "Message":
+        try:
+            raw_uuid, raw = record[cls.IDFieldName], record[cls.DataFieldName]
+        except KeyError as exc:
+            raise MessageError(f"Malformed message, record: {record} does not have fields {cls.IDFieldName} and {cls.DataFieldName} ") from exc
+        msg = cls.__new__(cls)
+        msg.stream = _stream(stream)
+        msg._msg_uuid = msg._data = _undecoded
+        msg._raw_uuid = raw_uuid
+        msg._raw = raw
+        msg._content_type = record.get(cls.ContentTypeFieldName)
+        return msg
+
+    @property
+    def msg_uuid(self) -> uuid.UUID:
+        if self._msg_uuid is _undecoded:
+            self._msg_uuid = uuid.UUID(self._raw_uuid.decode("ascii"))
+        return self._msg_uuid
+
+    @property
+    def data(self) -> dict:
+        if self._data is _undecoded:
+            self._data = codecs.decode(self._content_type, self._raw)
+        return self._data
+
+    # Assigning the data replaces the raw bytes it was read from
+    @data.setter
+    def data(self, data: dict) -> None:
+        self._data = data
+        self._raw = self._content_type = None
+
+    # The encoded data, for a message read from a stream these are the bytes as they have been read which
+    # allows passing it on to another stream without decoding it first.
+    @property
+    def raw(self) -> bytes:
+        return self.encode()[1]
+
+    # The content type and the encoded data, a message read from a stream keeps the codec it has been sent with.
+    def encode(self, codec: Optional[Codec] = None) -> Tuple[bytes, bytes]:
+        if self._raw is not None:
+            return self._content_type or codecs.JSON, self._raw
+        return (codec or codecs.default_codec).encode(self._data)
 
     def __repr__(self):
         return f"<Message self.stream:{self.stream} msd_id:{self.msg_uuid} data:{self.data}>"
 
 
-def increment_msg_id(id) -> bytes:
-    # IDs are of the form "1509473251518-0" and comprise a millisecond
-    # timestamp plus a sequence number to differentiate within the timestamp.
-    time, sequence = id.decode("ascii").split("-")
-    if not sequence:
-        raise Exception("Argument error, {id} has wrong format not #-#")
-    next_sequence = int(sequence) + 1
+_undecoded = object()
+
+
+def _stream(stream: Union[bytes, str]) -> str:
+    if isinstance(stream, bytes):
+        stream = stream.decode("ascii")
+    return stream.replace("telstar:stream:", "")
+
 
-    return bytes(f"{time}-{next_sequence}", "ascii")
+# A stream id such as b"1509473251518-0" which comprises a millisecond timestamp plus a sequence number
+# to differentiate within the timestamp. Unlike the ids themselves these compare in the order redis assigns them
+# in (b"999-0" < b"1000-0" does not hold for the bytes). `bytes(id)` is what we hand back to redis.
+class StreamID(NamedTuple):
+    ms: int
+    seq: int = 0
+
+    @classmethod
+    def parse(cls, id: Union[bytes, str, "StreamID"]) -> "StreamID":
+        if isinstance(id, StreamID):
+            return id
+        # `int` takes bytes as well, no need to decode them
+        ms, sep, seq = id.partition(b"-" if isinstance(id, bytes) else "-")
+        return cls(int(ms), int(seq) if sep else 0)
+
+    @classmethod
+    def parse_many(cls, ids: Iterable[Union[bytes, str, "StreamID"]]) -> List["StreamID"]:
+        parse = cls.parse
+        return [parse(id) for id in ids]
+
+    def next(self) -> "StreamID":
+        return StreamID(self.ms, self.seq + 1)
+
+    # The id before, with a sequence of 0 this is the first id of the previous millisecond which is
+    # good enough for reading everything after it.
+    def previous(self) -> "StreamID":
+        if self.seq == 0:
+            return StreamID(self.ms - 1, 0)
+        return StreamID(self.ms, self.seq - 1)
+
+    def __str__(self) -> str:
+        return f"{self.ms}-{self.seq}"
+
+    def __bytes__(self) -> bytes:
+        return str(self).encode("ascii")
+
+
+def increment_msg_id(id) -> bytes:
+    return bytes(StreamID.parse(id).next())
 
 
 def decrement_msg_id(id: bytes) -> bytes:
-    time, sequence = id.decode("ascii").split("-")
-    if not sequence:
-        raise Exception("Argument error, {id} has wrong format not #-#")
-    sequence = int(sequence)
-    time = int(time)
-    if sequence == 0:
-        time = time - 1
-    else:
-        sequence = int(sequence) - 1
-
-    return bytes(f"{time}-{sequence}", "ascii")
+    return bytes(StreamID.parse(id).previous())
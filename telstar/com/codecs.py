@@ -0,0 +1,162 @@
+import json
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# A codec turns the data of a message into the bytes that go into `Message.DataFieldName` and back.
+# What it returns along with the bytes is the content type that is written into `Message.ContentTypeFieldName`,
+# consumers pick the codec to decode a message with by that field, so a stream can carry messages of different codecs.
+# Records without a content type are JSON, which is what has been written before there were codecs.
+# A content type can carry a `+zlib` suffix for a compressed payload, see `Compressed`.
+
+JSON = b"json"
+MSGPACK = b"msgpack"
+ZLIB = b"zlib"
+
+
+class CodecError(ValueError):
+    pass
+
+
+class TelstarEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+
+        if isinstance(o, uuid.UUID):
+            return str(o)
+
+        return json.JSONEncoder.default(self, o)
+
+
+class Codec:
+    content_type: bytes = None
+
+    def encode(self, data: Any) -> Tuple[bytes, bytes]:
+        raise NotImplementedError
+
+    def decode(self, raw: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    content_type = JSON
+
+    def __init__(self) -> None:
+        self.encoder = TelstarEncoder()
+
+    def encode(self, data: Any) -> Tuple[bytes, bytes]:
+        return self.content_type, self.encoder.encode(data).encode("utf-8")
+
+    def decode(self, raw: bytes) -> Any:
+        return json.loads(raw)
+
+
+# Same format as `JSONCodec` but several times faster, datetimes and uuids are handled by orjson itself.
+# Needs `orjson` to be installed. JSON is still decoded with `json` unless this is registered, orjson is stricter
+# than `json` (e.g. no NaN) and turns integers beyond 64 bits into floats.
+class ORJSONCodec(JSONCodec):
+    def __init__(self) -> None:
+        if orjson is None:
+            raise CodecError(f"{self.__class__.__name__} needs orjson to be installed")
+
+    def encode(self, data: Any) -> Tuple[bytes, bytes]:
+        return self.content_type, orjson.dumps(data)
+
+    def decode(self, raw: bytes) -> Any:
+        return orjson.loads(raw)
+
+
+# More compact than JSON, datetimes and uuids are written as strings just like `TelstarEncoder` does.
+# Needs `msgpack` to be installed.
+class MsgpackCodec(Codec):
+    content_type = MSGPACK
+
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise CodecError(f"{self.__class__.__name__} needs msgpack to be installed")
+
+    def encode(self, data: Any) -> Tuple[bytes, bytes]:
+        return self.content_type, msgpack.packb(data, default=self._default, use_bin_type=True)
+
+    def decode(self, raw: bytes) -> Any:
+        return msgpack.unpackb(raw, raw=False)
+
+    @staticmethod
+    def _default(o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        if isinstance(o, uuid.UUID):
+            return str(o)
+        raise TypeError(f"Object of type {o.__class__.__name__} is not msgpack serializable")
+
+
+# Compresses the payloads of `codec` with zlib once they are at least `threshold` bytes long,
+# smaller ones don't get any smaller and are left as they are.
+class Compressed(Codec):
+    def __init__(self, codec: Codec, threshold: int = 1024, level: int = 6) -> None:
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, data: Any) -> Tuple[bytes, bytes]:
+        content_type, raw = self.codec.encode(data)
+        if len(raw) < self.threshold:
+            return content_type, raw
+        return content_type + b"+" + ZLIB, zlib.compress(raw, self.level)
+
+    def decode(self, raw: bytes) -> Any:
+        return self.codec.decode(raw)
+
+
+_codecs: Dict[bytes, Codec] = dict()
+
+
+# Makes messages of `codec.content_type` decodable, replacing the codec registered for it before
+def register(codec: Codec) -> None:
+    _codecs[codec.content_type] = codec
+
+
+def get_codec(content_type: bytes) -> Codec:
+    try:
+        return _codecs[content_type]
+    except KeyError:
+        raise CodecError(f"No codec registered for content type: {content_type}") from None
+
+
+# Whatever is wrong with the payload is raised as a `CodecError`
+def decode(content_type: Optional[bytes], raw: bytes) -> Any:
+    content_type, _, encoding = (content_type or JSON).partition(b"+")
+    if encoding == ZLIB:
+        try:
+            raw = zlib.decompress(raw)
+        except zlib.error as exc:
+            raise CodecError(f"Could not decompress the payload: {exc}") from exc
+    elif encoding:
+        raise CodecError(f"Unknown encoding: {encoding}")
+    codec = get_codec(content_type)
+    try:
+        return codec.decode(raw)
+    except CodecError:
+        raise
+    except (ValueError, TypeError) as exc:
+        raise CodecError(f"Could not decode the payload as {content_type}: {exc}") from exc
+
+
+# What messages are encoded with unless a producer is given a codec
+default_codec = JSONCodec()
+
+register(default_codec)
+if msgpack is not None:
+    register(MsgpackCodec())
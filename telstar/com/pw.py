@@ -2,7 +2,7 @@
 import json
 import uuid
 from datetime import datetime, timedelta
-from typing import TYPE_CHECKING, Dict, List, Union
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
 
 import peewee
 from peewee import ModelSelect
@@ -29,6 +29,19 @@ class StagedMessage(peewee.Model):
     sent = peewee.BooleanField(default=False, index=True)
     send_at = peewee.TimestampField(resolution=10**3)
     created_at = peewee.TimestampField(resolution=10**3)
+    # When the message has been sent, what `purge_sent` deletes by
+    sent_at = peewee.TimestampField(resolution=10**3, null=True, default=None, index=True)
+
+    # Which producer has claimed the message until when, see `claim`. Selected by every query, so existing tables
+    # need these columns whether or not messages are claimed, see "Upgrading existing outbox tables" in the README.
+    lease_owner = peewee.CharField(null=True, default=None)
+    lease_expires = peewee.TimestampField(resolution=10**3, null=True, default=None)
+
+    class Meta:
+        # What `unsent` polls by
+        indexes = (
+            (("sent", "send_at", "id"), False),
+        )
 
     @classmethod
     def create(cls, **kwargs):
@@ -37,15 +50,91 @@ class StagedMessage(peewee.Model):
             kwargs["send_at"] = datetime.now() + timedelta(seconds=delay)
         return super().create(**kwargs)
 
+    # Stages all of `messages`, pairs of topic and data, with multi row INSERTs and returns their uuids
+    @classmethod
+    def create_many(cls, messages: List[Tuple[str, Dict]], delay: int = 0, batch_size: int = 100) -> List[uuid.UUID]:
+        now = datetime.now()
+        send_at = now + timedelta(seconds=delay)
+        rows = [dict(msg_uid=uuid.uuid4(), topic=topic, data=data, send_at=send_at, created_at=now) for topic, data in messages]
+        for batch in peewee.chunked(rows, batch_size):
+            cls.insert_many(batch).execute()
+        return [row["msg_uid"] for row in rows]
+
+    # The messages that are due to be sent in the order they have been staged in, with `after_id` only those
+    # staged after that one which allows paging through them by id rather than by offset.
+    @classmethod
+    def unsent(cls, after_id: Optional[int] = None) -> ModelSelect:
+        query = cls.select().where(cls.sent == False, cls.send_at <= datetime.now())  # noqa
+        if after_id is not None:
+            query = query.where(cls.id > after_id)
+        return query.order_by(cls.id)
+
+    # Deletes the messages that have been sent more than `older_than` seconds ago in chunks of `chunk_size` rows,
+    # each chunk in a transaction of its own so the table is never locked for long. With `archive` each chunk is
+    # handed to it before it gets deleted. Returns the number of deleted messages. Messages sent before there was
+    # a `sent_at` go by their `send_at` instead.
+    @classmethod
+    def purge_sent(cls, older_than: float, chunk_size: int = 1000, archive: Optional[Callable[[List["StagedMessage"]], None]] = None) -> int:
+        before = datetime.now() - timedelta(seconds=older_than)
+        purged = 0
+        while True:
+            with cls._meta.database.atomic():
+                query = cls.select() if archive is not None else cls.select(cls.id)
+                sent_before = (cls.sent_at < before) | (cls.sent_at.is_null() & (cls.send_at < before))
+                rows = list(query.where(cls.sent == True, sent_before).order_by(cls.id).limit(chunk_size))  # noqa
+                if not rows:
+                    break
+                if archive is not None:
+                    archive(rows)
+                cls.delete().where(cls.id << [row.id for row in rows]).execute()
+            purged += len(rows)
+            if len(rows) < chunk_size:
+                break
+        return purged
+
+    # Claims up to `limit` unsent messages for `owner`, which allows several producers to send from the same table.
+    # With `skip_locked` the rows are locked with `SELECT ... FOR UPDATE SKIP LOCKED` until the transaction ends,
+    # otherwise they are leased for `lease` seconds by writing the owner and the expiry into the row. Rows whose lease
+    # has expired are claimed again. By default rows are locked where the database supports it.
+    @classmethod
+    def claim(cls, limit: int, owner: str, lease: float = 30.0, skip_locked: Optional[bool] = None) -> List["StagedMessage"]:
+        if skip_locked is None:
+            skip_locked = cls.supports_skip_locked()
+        if skip_locked:
+            return list(cls.unsent().order_by(cls.id).limit(limit).for_update("FOR UPDATE SKIP LOCKED"))
+
+        now = datetime.now()
+        free = cls.lease_owner.is_null() | (cls.lease_expires < now)
+        ids = [m.id for m in cls.unsent().select(cls.id).where(free).order_by(cls.id).limit(limit)]
+        if not ids:
+            return []
+        # Someone else may have been quicker, the lease is only taken where it is still free
+        token = f"{owner}:{uuid.uuid4().hex}"
+        cls.update(lease_owner=token, lease_expires=now + timedelta(seconds=lease)).where(cls.id << ids, cls.sent == False, free).execute()  # noqa
+        return list(cls.select().where(cls.lease_owner == token).order_by(cls.id))
+
+    # Gives up the lease on those of `messages`, all of one claim, that have not been sent
+    @classmethod
+    def release(cls, messages: List["StagedMessage"]) -> None:
+        if not messages:
+            return
+        cls.update(lease_owner=None, lease_expires=None).where(
+            cls.id << [m.id for m in messages], cls.lease_owner == messages[0].lease_owner, cls.sent == False).execute()  # noqa
 
     @classmethod
-    def unsent(cls) -> ModelSelect:
-        return cls.select().where(cls.sent == False, cls.send_at <= datetime.now())  # noqa
+    def supports_skip_locked(cls) -> bool:
+        database = cls._meta.database
+        if isinstance(database, peewee.PostgresqlDatabase):
+            return True
+        if isinstance(database, peewee.MySQLDatabase):
+            database.connect(reuse_if_open=True)
+            return database.server_version >= (8, 0)
+        return False
 
     @classmethod
     def mark_as_sent(cls, messages: List["Message"]):
         ids = list(map(lambda m: m.id, messages))
-        cls.update(sent=True).where(cls.id << ids).execute()
+        cls.update(sent=True, sent_at=datetime.now()).where(cls.id << ids).execute()
 
     @classmethod
     def get_transaction_wrapper(cls):
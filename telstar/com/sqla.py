@@ -1,11 +1,14 @@
 import json
 import uuid
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
 
-from sqlalchemy import TIMESTAMP, BigInteger, Boolean, Column, String, Text
+from sqlalchemy import TIMESTAMP, BigInteger, Boolean, Column, Index, String, Text, and_, or_
 from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.dialects.postgresql import UUID as psqlUUID
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.types import BINARY, TypeDecorator
 from sqlalchemy.sql import functions as func
 
@@ -81,6 +84,10 @@ class UUID(TypeDecorator):
 
 class StagedMessage(Base):
     __tablename__ = 'telstar_staged_message'
+    # What `unsent` polls by
+    __table_args__ = (
+        Index("ix_telstar_staged_message_sent_send_at_id", "sent", "send_at", "id"),
+    )
 
     id = Column(BigIntegerType, primary_key=True)
     msg_uid = Column(UUID(), index=True, nullable=False, default=lambda: uuid.uuid4())
@@ -90,6 +97,13 @@ class StagedMessage(Base):
     sent = Column(Boolean(), default=False, index=True)
     send_at = Column(TIMESTAMP())
     created_at = Column(TIMESTAMP(), server_default=func.now())
+    # When the message has been sent, what `purge_sent` deletes by
+    sent_at = Column(TIMESTAMP(), nullable=True, index=True)
+
+    # Which producer has claimed the message until when, see `claim`. Selected by every query, so existing tables
+    # need these columns whether or not messages are claimed, see "Upgrading existing outbox tables" in the README.
+    lease_owner = Column(String(length=255), nullable=True)
+    lease_expires = Column(TIMESTAMP(), nullable=True)
 
     def to_telstar(self):
         from . import Message
@@ -108,20 +122,115 @@ class _StagedMessageRepository:
         self.db.add(obj)
         return obj
 
+    # Stages all of `messages`, pairs of topic and data, with multi row INSERTs and returns their uuids
+    def create_many(self, messages: List[Tuple[str, Dict]], delay: int = 0, batch_size: int = 100) -> List[uuid.UUID]:
+        send_at = datetime.now() + timedelta(seconds=delay)
+        rows = [dict(msg_uid=uuid.uuid4(), topic=topic, data=data, send_at=send_at) for topic, data in messages]
+        for i in range(0, len(rows), batch_size):
+            self.db.execute(self.model.__table__.insert().values(rows[i:i + batch_size]))
+        return [row["msg_uid"] for row in rows]
+
     def setup(self, database):
         self.db = database
 
     def get_transaction_wrapper(self):
         return self.db.begin
 
-    def unsent(self):
+    # The messages that are due to be sent in the order they have been staged in, with `after_id` only those
+    # staged after that one which allows paging through them by id rather than by offset.
+    def unsent(self, after_id: Optional[int] = None):
         # We look into past when sending
         # If you remove the timedelta we get strange errors
-        return self.db.query(self.model).filter(self.model.sent == False, self.model.send_at <= datetime.now() + timedelta(seconds=1)).order_by(self.model.id)
-
+        query = self.db.query(self.model).filter(self.model.sent == False, self.model.send_at <= datetime.now() + timedelta(seconds=1))  # noqa
+        if after_id is not None:
+            query = query.filter(self.model.id > after_id)
+        return query.order_by(self.model.id)
+
+    # Deletes the messages that have been sent more than `older_than` seconds ago in chunks of `chunk_size` rows,
+    # each chunk in a transaction of its own so the table is never locked for long. With `archive` each chunk is
+    # handed to it before it gets deleted. Returns the number of deleted messages. Messages sent before there was
+    # a `sent_at` go by their `send_at` instead.
+    def purge_sent(self, older_than: float, chunk_size: int = 1000, archive: Optional[Callable[[List[StagedMessage]], None]] = None) -> int:
+        before = datetime.now() - timedelta(seconds=older_than)
+        purged = 0
+        sent_before = or_(self.model.sent_at < before, and_(self.model.sent_at.is_(None), self.model.send_at < before))
+        while True:
+            with self._transaction():
+                query = self.db.query(self.model) if archive is not None else self.db.query(self.model.id)
+                rows = query.filter(self.model.sent == True, sent_before).order_by(self.model.id).limit(chunk_size).all()  # noqa
+                if not rows:
+                    break
+                if archive is not None:
+                    archive(rows)
+                self.db.query(self.model).filter(self.model.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            purged += len(rows)
+            if len(rows) < chunk_size:
+                break
+        return purged
+
+    # A transaction of its own, begun on an autocommit session and committed at the end on any other
+    @contextmanager
+    def _transaction(self):
+        if self.db.autocommit:
+            with self.db.begin():
+                yield
+            return
+        try:
+            yield
+        except Exception:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+    # Claims up to `limit` unsent messages for `owner`, which allows several producers to send from the same table.
+    # With `skip_locked` the rows are locked with `SELECT ... FOR UPDATE SKIP LOCKED` until the transaction ends,
+    # otherwise they are leased for `lease` seconds by writing the owner and the expiry into the row. Rows whose lease
+    # has expired are claimed again. By default rows are locked where the database supports it.
+    def claim(self, limit: int, owner: str, lease: float = 30.0, skip_locked: Optional[bool] = None) -> List[StagedMessage]:
+        if skip_locked is None:
+            skip_locked = self.supports_skip_locked()
+        if skip_locked:
+            return self.unsent().limit(limit).with_for_update(skip_locked=True).all()
+
+        now = datetime.now()
+        free = or_(self.model.lease_owner.is_(None), self.model.lease_expires < now)
+        ids = [id for id, in self.unsent().filter(free).with_entities(self.model.id).limit(limit)]
+        if not ids:
+            return []
+        # Someone else may have been quicker, the lease is only taken where it is still free
+        token = f"{owner}:{uuid.uuid4().hex}"
+        self.db.query(self.model).filter(self.model.id.in_(ids), self.model.sent == False, free).update(  # noqa
+            {self.model.lease_owner: token, self.model.lease_expires: now + timedelta(seconds=lease)}, synchronize_session=False)
+        return self.db.query(self.model).filter(self.model.lease_owner == token).order_by(self.model.id).all()
+
+    # Gives up the lease on those of `messages`, all of one claim, that have not been sent
+    def release(self, messages: List[StagedMessage]) -> None:
+        if not messages:
+            return
+        self.db.query(self.model).filter(
+            self.model.id.in_([m.id for m in messages]), self.model.lease_owner == messages[0].lease_owner, self.model.sent == False  # noqa
+        ).update({self.model.lease_owner: None, self.model.lease_expires: None}, synchronize_session=False)
+
+    def supports_skip_locked(self) -> bool:
+        dialect = self.db.get_bind().dialect
+        if dialect.name == "postgresql":
+            return True
+        if dialect.name == "mysql":
+            # The server version is only known once the engine has connected
+            return (self.db.connection().dialect.server_version_info or (0,)) >= (8, 0)
+        return False
+
+    # A single UPDATE for all of them, the objects in the session are updated without another UPDATE per row
     def mark_as_sent(self, messages):
+        if not messages:
+            return
+        ids = [m.id for m in messages]
+        sent_at = datetime.now()
+        self.db.query(self.model).filter(self.model.id.in_(ids)).update(
+            {self.model.sent: True, self.model.sent_at: sent_at}, synchronize_session=False)
         for m in messages:
-            m.sent = True
+            set_committed_value(m, "sent", True)
+            set_committed_value(m, "sent_at", sent_at)
 
 
 StagedMessageRepository = _StagedMessageRepository()
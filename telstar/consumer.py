@@ -1,14 +1,25 @@
-import json
+import heapq
+import inspect
 import logging
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import sys
 import threading
 import time
-import uuid
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import Callable, Dict
+from itertools import groupby, islice
+from operator import itemgetter
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
 
 import redis
 
-from .com import Message, decrement_msg_id, increment_msg_id, MessageError
+from .com import Message, MessageError, StreamID
+from .dedup import SeenCache, SeenKeys, SeenStore
 
 # An important concept to understand here is the consumer group which give us the following consumer properties:
 # msg   -> consumer
@@ -27,33 +38,239 @@ from .com import Message, decrement_msg_id, increment_msg_id, MessageError
 
 log = logging.getLogger(__name__)
 
+# Does what `MultiConsumer.acknowledge` does in a pipeline but atomically on the server, in one round trip.
+# KEYS: seen key, checkpoint key, stream - ARGV: group, stream_msg_id, seen key ttl, 1 to set the checkpoint or 0
+# Returns 1 if the message has been marked as seen by this call and 0 if it had been seen before.
+ACKNOWLEDGE_SCRIPT = """
+local function parse(id)
+    local ms, seq = string.match(id, "^(%d+)-(%d+)$")
+    return tonumber(ms), tonumber(seq)
+end
+
+local fresh = redis.call("SET", KEYS[1], 1, "EX", ARGV[3], "NX")
+if not fresh then
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+end
+
+-- Only ever move the checkpoint forward
+local current = redis.call("GET", KEYS[2])
+local forward = ARGV[4] == "1"
+if forward and current then
+    local cur_ms, cur_seq = parse(current)
+    local new_ms, new_seq = parse(ARGV[2])
+    if cur_ms and new_ms then
+        forward = new_ms > cur_ms or (new_ms == cur_ms and new_seq > cur_seq)
+    end
+end
+if forward then
+    redis.call("SET", KEYS[2], ARGV[2])
+end
+
+redis.call("XACK", KEYS[3], ARGV[1], ARGV[2])
+if fresh then
+    return 1
+end
+return 0
+"""
+
+
+# Keeps track of which messages of a batch have been acknowledged, when they are acknowledged out of order the
+# checkpoint of a stream may only move up to the last message whose predecessors have all been acknowledged too.
+class BatchProgress:
+    def __init__(self, response: list) -> None:
+        self._ids: Dict[str, List[StreamID]] = defaultdict(list)
+        for stream_name, records in response:
+            self._ids[self._str(stream_name)].extend(StreamID.parse_many(stream_msg_id for stream_msg_id, _ in records))
+        self._acknowledged = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _str(value: Union[str, bytes]) -> str:
+        return value.decode("ascii") if isinstance(value, bytes) else value
+
+    def complete(self, stream_name: Union[str, bytes], stream_msg_id: Union[StreamID, bytes, str]) -> None:
+        with self._lock:
+            self._acknowledged.add((self._str(stream_name), StreamID.parse(stream_msg_id)))
+
+    def checkpoints(self) -> Dict[str, StreamID]:
+        checkpoints = dict()
+        with self._lock:
+            for stream_name, ids in self._ids.items():
+                for stream_msg_id in ids:
+                    if (stream_name, stream_msg_id) not in self._acknowledged:
+                        break
+                    checkpoints[stream_name] = stream_msg_id
+        return checkpoints
+
+
+# A processor that is handed the messages of its streams in batches rather than one by one, for sinks where writing
+# in bulk is far cheaper. `fn(consumer, msgs)` returns whether each of the messages has been processed, or `None` if
+# all of them have. The successful ones are acknowledged together, the others remain pending and are read again
+# when catching up. A batch is handed over once `max_batch` messages have been read or the first of them has been
+# waiting for `max_wait_ms`.
+class BatchProcessor:
+    def __init__(self, fn: Callable[["MultiConsumer", List[Message]], Optional[List[bool]]], max_batch: int = 100, max_wait_ms: int = 0) -> None:
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+
+    def __call__(self, consumer: "MultiConsumer", msgs: List[Message]) -> Optional[List[bool]]:
+        return self.fn(consumer, msgs)
+
+
+# Calls `read` over and over in a thread of its own and keeps up to `depth` of the non empty responses in a queue.
+# Once the queue is full the reader waits for a response to be taken, which bounds the messages held in memory and
+# stops us from reading more than we can process. Errors of `read` are raised by `get` and end the reader.
+class Prefetcher:
+    def __init__(self, read: Callable[[], list], depth: int, name: Optional[str] = None) -> None:
+        self._read = read
+        self.queue: "queue.Queue[Tuple[float, Union[list, Exception]]]" = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    # Responses that have been waiting for `max_age` seconds or longer are dropped rather than returned
+    def get(self, timeout: Optional[float] = None, max_age: Optional[float] = None) -> list:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                read_at, response = self.queue.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return []
+            if isinstance(response, Exception):
+                raise response
+            if max_age is None or time.monotonic() - read_at < max_age:
+                return response
+            log.warning(f"Dropping {sum(len(records) for _, records in response)} prefetched message(s) that have been waiting for too long")
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                response = self._read()
+            except Exception as exc:
+                log.exception("Prefetching failed")
+                self._put(exc)
+                return
+            if response:
+                self._put(response)
+
+    def _put(self, response: Union[list, Exception]) -> None:
+        read_at = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                return self.queue.put((read_at, response), timeout=0.1)
+            except queue.Full:
+                continue
+
 
 class MultiConsumer(object):
+    # Whether the processors may be coroutine functions, which only the asyncio consumers can await
+    _awaits_processors = False
 
-    def __init__(self, link: redis.Redis, group_name: str, consumer_name: str, config: dict, block: int = 2000, claim_the_dead_after: int = 20 * 1000, error_handlers=None) -> None:
+    def __init__(self, link: redis.Redis, group_name: str, consumer_name: str, config: dict, block: int = 2000, claim_the_dead_after: int = 20 * 1000, error_handlers=None,
+                 batch_ack: bool = False, batch_ack_size: int = 100, batch_ack_timeout: int = 1000, atomic_ack: bool = False,
+                 catchup_page_size: Optional[int] = 500, autoclaim: bool = False, claim_page_size: int = 100,
+                 process_claimed: bool = False, claim_interval: Optional[int] = None, seen_store: Optional[SeenStore] = None,
+                 seen_cache: Optional[SeenCache] = None, max_workers: int = 1,
+                 partition_key: Optional[Union[str, Callable[[Message], Hashable]]] = None, prefetch: int = 0,
+                 checkpoint_interval: Optional[int] = None) -> None:
         self.link = link
         self.block = block
+        # Claiming from the dead runs at most every `claim_interval` ms and not on every iteration of the read loop
+        self.claim_interval = claim_the_dead_after / 2 if claim_interval is None else claim_interval
+        self._last_claim: Optional[float] = None
+        # The checkpoints are read from redis once and then kept in memory, they only ever move forward.
+        # By default a checkpoint is written along with every acknowledgement, with `checkpoint_interval` they are
+        # written at most every `checkpoint_interval` ms (0 meaning once per batch) and when the consumer is closed.
+        # Should the consumer die in between it reads a few messages again, which the seen store skips.
+        self._checkpoints: Dict[str, StreamID] = dict()
+        self.checkpoint_interval = checkpoint_interval
+        self._unsaved_checkpoints: Dict[str, StreamID] = dict()
+        self._checkpoints_saved = time.monotonic()
+        # With `autoclaim` dead consumers are recovered with XAUTOCLAIM (redis >= 6.2) in pages of `claim_page_size`
+        self.autoclaim = autoclaim
+        self.claim_page_size = claim_page_size
+        # With `process_claimed` only the claimed messages are processed instead of replaying the history
+        self.process_claimed = process_claimed
+        # Catching up reads the history in pages of at most this many records per stream, `None` reads it all at once
+        self.catchup_page_size = catchup_page_size
         self.claim_the_dead_after = claim_the_dead_after
         self.consumer_name = consumer_name
         self.group_name = group_name
         self.error_handlers = error_handlers or {}
+        # The number of messages read so far, double sends included
+        self.processed = 0
+
+        # With `batch_ack` the `done()` calls are buffered and flushed in a single transaction, either at the end
+        # of each `_xreadgroup` batch or once `batch_ack_size` messages or `batch_ack_timeout` ms have accumulated.
+        self.batch_ack = batch_ack
+        self.batch_ack_size = batch_ack_size
+        self.batch_ack_timeout = batch_ack_timeout
+        # The buffered acknowledgements and whether they are for double sends, see `acknowledge`
+        self._ack_buffer: List[Tuple[Message, StreamID, bool]] = []
+        self._ack_buffer_started = 0.0
+        self._ack_lock = threading.RLock()
+        self._batch_acked = set()
 
+        # With `max_workers` a batch is processed by a pool of threads. Messages with the same `partition_key`, either
+        # a field of the message data or a function of the message, are processed in order, all others concurrently.
+        # Without a key only double sends are kept apart. The checkpoint is only moved once the batch is done, up
+        # to the last message all of whose predecessors have been acknowledged as well.
+        self.max_workers = max_workers
+        self.partition_key = partition_key
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._progress: Optional[BatchProgress] = None
+
+        # With `prefetch` new messages are read by a thread of its own while the current batch is processed,
+        # up to `prefetch` batches of at most `catchup_page_size` records are kept waiting, see `Prefetcher`.
+        # Waiting messages are pending for this consumer already, once they have been waiting for `claim_the_dead_after`
+        # other consumers may claim them, so they are dropped and left to whoever claims them, us included.
+        self.prefetch = prefetch
+        self._prefetcher: Optional[Prefetcher] = None
+
+        # Where we remember which messages have been processed, by default a key per message
+        self.seen_store = seen_store or SeenKeys()
+        # Optionally the messages we have acknowledged ourselves are looked up in process first
+        self.seen_cache = seen_cache
+
+        # With `atomic_ack` the dedupe, checkpoint and ack happen in a server side script (EVALSHA),
+        # should scripting not be available we fall back to the WATCH/MULTI/EXEC pipeline.
+        # The script works on the per message keys only.
+        if atomic_ack and not isinstance(self.seen_store, SeenKeys):
+            log.warning(f"Group: '{self.group_name}' atomic acknowledgements require {SeenKeys.__name__}, falling back to pipelined acknowledgements")
+            atomic_ack = False
+        self._ack_script = self.link.register_script(ACKNOWLEDGE_SCRIPT) if atomic_ack else None
+
+        self._check_processors(config)
         self.processors = {f"telstar:stream:{stream_name}": fn
                            for stream_name, fn in config.items()}
 
         self.streams = self.processors.keys()
-        for stream_name in self.streams:
-            self.create_consumer_group(stream_name)
+
+        # The records read for the `BatchProcessor`s, they are held here until their batch is due
+        self._batch_processors = list(OrderedDict.fromkeys(fn for fn in self.processors.values() if isinstance(fn, BatchProcessor)))
+        self._batches: Dict[BatchProcessor, Dict[Tuple[bytes, StreamID], Dict[bytes, bytes]]] = {fn: OrderedDict() for fn in self._batch_processors}
+        self._batch_started: Dict[BatchProcessor, float] = dict()
+        self._create_consumer_groups()
 
     def get_consumer_name(self, stream: str) -> str:
         return f"cg:{self.group_name}:{self.consumer_name}"
 
     def _seen_key(self, msg: Message) -> str:
-        return f"telstar:seen:{msg.stream}:{self.group_name}:{msg.msg_uuid}"
+        return SeenKeys().key(self.group_name, msg.stream, str(msg.msg_uuid))
 
     def _checkpoint_key(self, stream: str) -> str:
         return f"telstar:checkpoint:{stream}:{self.get_consumer_name(stream)}"
 
+    def _create_consumer_groups(self) -> None:
+        for stream_name in self.streams:
+            self.create_consumer_group(stream_name)
+
     # A new consumer group for the given stream, if the stream does not exist yet
     # create one (`mkstream`) - if it does we want all messages present `id=0`
     def create_consumer_group(self, stream_name: str) -> None:
@@ -64,7 +281,9 @@ class MultiConsumer(object):
 
     # In consumer groups, consumers can disappear, when they do they can leave non ack'ed message
     # which we want to claim and be delivered to a new consumer
-    def claim_message_from_the_dead(self, stream_name: str) -> None:
+    def claim_message_from_the_dead(self, stream_name: str) -> Optional[List[StreamID]]:
+        if self.autoclaim:
+            return StreamID.parse_many(stream_msg_id for page in self.autoclaim_message_from_the_dead(stream_name) for stream_msg_id, _ in page)
         # Get information about all consumers in the group and how many messages are pending
         pending_info = self.link.xpending(stream_name, self.group_name)
         # {'pending': 10,
@@ -97,12 +316,70 @@ class MultiConsumer(object):
         log.debug(f"Stream: '{stream_name}' in Group: '{self.group_name}' claiming: {len(messages_to_claim)} message(s)")
         claimed_messages = self.link.xclaim(stream_name, self.group_name, self.consumer_name, self.claim_the_dead_after, messages_to_claim, justid=True)
         log.debug(f"Stream: '{stream_name}' in Group: '{self.group_name}' claimed: {len(messages_to_claim)} message(s)")
-        return claimed_messages
+        return StreamID.parse_many(claimed_messages)
+
+    # Same as `claim_message_from_the_dead` but with XAUTOCLAIM, which means redis walks the pending entries
+    # list from a cursor and only hands out messages that are idle for longer than `claim_the_dead_after`.
+    # Each call claims at most `claim_page_size` messages which keeps the replies small and redis responsive.
+    # The claimed messages are yielded page by page together with their bodies so they can be processed right away.
+    # (We can't use JUSTID as redis-py drops the cursor from the reply when doing so.)
+    def autoclaim_message_from_the_dead(self, stream_name: str) -> Iterator[List[Tuple[bytes, Dict[bytes, bytes]]]]:
+        cursor = b"0-0"
+        while True:
+            # Redis >= 7 also replies with the ids of deleted messages which it already removed from the pending list
+            cursor, records, *_ = self.link.xautoclaim(stream_name, self.group_name, self.consumer_name, self.claim_the_dead_after,
+                                                       start_id=cursor, count=self.claim_page_size)
+            # Messages which have been deleted in the meantime come back without a body (redis 6.2)
+            records = [(stream_msg_id, record) for stream_msg_id, record in records if record is not None]
+            if records:
+                log.debug(f"Stream: '{stream_name}' in Group: '{self.group_name}' claimed: {len(records)} message(s)")
+                yield records
+            if cursor in (b"0-0", "0-0"):
+                return
+
+    # Claims the messages of dead consumers together with their bodies, page by page. The pending entries list is walked
+    # with XPENDING in pages of `claim_page_size` and every page gets XCLAIM'ed, redis only hands out the messages
+    # which are idle for longer than `claim_the_dead_after`.
+    def claim_pages_from_the_dead(self, stream_name: str) -> Iterator[List[Tuple[bytes, Dict[bytes, bytes]]]]:
+        if self.autoclaim:
+            yield from self.autoclaim_message_from_the_dead(stream_name)
+            return
+        start = "-"
+        while True:
+            pending_messages = self.link.xpending_range(stream_name, self.group_name, start, "+", self.claim_page_size)
+            if not pending_messages:
+                return
+            claimed = self.link.xclaim(stream_name, self.group_name, self.consumer_name, self.claim_the_dead_after,
+                                       [p["message_id"] for p in pending_messages])
+            # Messages which have been deleted in the meantime come back without a body
+            records = [(stream_msg_id, record) for stream_msg_id, record in claimed if record is not None]
+            if records:
+                log.debug(f"Stream: '{stream_name}' in Group: '{self.group_name}' claimed: {len(records)} message(s)")
+                yield records
+            if len(pending_messages) < self.claim_page_size:
+                return
+            start = bytes(StreamID.parse(pending_messages[-1]["message_id"]).next())
+
+    # Instead of rewinding to the earliest claimed message and replaying the whole history from there
+    # (with the potential of a lot of already seen keys) we process exactly the messages we have claimed.
+    def process_claimed_messages(self, streams: list) -> int:
+        processed = 0
+        for stream_name in streams:
+            for records in self.claim_pages_from_the_dead(stream_name):
+                processed += self._process([(stream_name.encode("ascii"), records)])
+        return processed
 
     # We claim the message from other dead/non-responsive consumers.
     # When new message have been claimed they are usually from the past
     # which means in order to process them we need to start processing our history.
     def transfer_and_process_stream_history(self, streams: list):
+        if self.process_claimed:
+            log.info(f"Stream: '{', '.join(streams)}' in Group: '{self.group_name}' as Consumer: '{self.consumer_name}' processing claimed messages")
+            # The claimed messages are usually older than the checkpoint, which must not be moved back by them
+            for stream_name in streams:
+                self.get_last_seen_id(stream_name)
+            self.process_claimed_messages(streams)
+            return
         last_seen = dict()
         for stream_name in streams:
             last_seen[stream_name] = self.get_last_seen_id(stream_name)
@@ -110,31 +387,129 @@ class MultiConsumer(object):
             if stream_msg_ids:
                 # if there are message that we have claimed we need to determine where to start processing
                 # because we can't just wait for new message to arrive.
-                before_earliest = decrement_msg_id(min(stream_msg_ids))
-                next_after_seen = increment_msg_id(last_seen[stream_name])
+                before_earliest = min(stream_msg_ids).previous()
+                next_after_seen = last_seen[stream_name].next()
                 last_seen[stream_name] = min([before_earliest, next_after_seen])
         # Read all message for the past up until now.
         log.info(f"Stream: '{', '.join(last_seen)}' in Group: '{self.group_name}' as Consumer: '{self.consumer_name}' reading past messages")
-        self.catchup(last_seen)
+        self.catchup({stream_name: bytes(stream_msg_id) for stream_name, stream_msg_id in last_seen.items()})
 
     # This is the main loop where we start from the history
     # and claim message and reprocess our history.
     # We also loop the transfer_and_process_history as other consumers might have died while we waited
     def run(self):
         log.info(f"Starting consumer loop for Group {self.group_name}")
-        while True:
-            self.run_once()
+        try:
+            while True:
+                self.run_once()
+        finally:
+            self.close()
 
     def run_once(self) -> None:
-        self.transfer_and_process_stream_history(self.streams)
+        if self.claim_is_due():
+            self.transfer_and_process_stream_history(self.streams)
+            self._last_claim = time.monotonic()
         # With our history processes we can now start waiting for new message to arrive `>`
         config = {k: ">" for k in self.streams}
         log.info(f"Stream: '{', '.join(self.streams)}' in Group: '{self.group_name}' as Consumer: '{self.consumer_name}' reading pending message or waiting for new")
-        self.read(config, block=self.block)
+        block = self._read_block()
+        if self.prefetch:
+            self._process(self._prefetched(config, block))
+        else:
+            self.read(config, block=block)
+        self._deliver_batches()
+        self.save_checkpoints()
 
-    def get_last_seen_id(self, stream_name: str) -> bytes:
-        check_point_key = self._checkpoint_key(stream_name)
-        return self.link.get(check_point_key) or b"0-0"
+    # How long to wait for new messages, no longer than until the first of the waiting batches is due
+    def _read_block(self) -> Optional[int]:
+        now = time.monotonic()
+        waits = [processor.max_wait_ms - (now - started) * 1000 for processor, started in self._batch_started.items()
+                 if self._batches[processor]]
+        if not waits or self.block is None:
+            return self.block
+        wait = max(1, int(math.ceil(min(waits))))
+        return min(self.block, wait) if self.block else wait
+
+    # The next batch the prefetcher has read, or nothing if none arrives within `block` ms
+    def _prefetched(self, streams: Dict[str, str], block: Optional[int] = None) -> list:
+        if self._prefetcher is None:
+            read = partial(self.link.xreadgroup, self.group_name, self.consumer_name, streams, count=self.catchup_page_size, block=self.block)
+            self._prefetcher = Prefetcher(read, self.prefetch, name=f"telstar-{self.group_name}-prefetch")
+            self._prefetcher.start()
+        try:
+            block = self.block if block is None else block
+            return self._prefetcher.get(timeout=block / 1000 if block else None, max_age=self.claim_the_dead_after / 1000)
+        except Exception:
+            # The reader has given up, the next iteration starts a new one
+            self._prefetcher = None
+            raise
+
+    # Stops the prefetcher and the worker pool and writes the checkpoints that have not been written yet. The messages
+    # that have been prefetched but not processed as well as those waiting for their batch remain pending and are
+    # picked up again when catching up.
+    def close(self) -> None:
+        self.save_checkpoints(force=True)
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    # `async def` processors would only be called and never awaited, so their messages would never be acknowledged
+    @classmethod
+    def _check_processors(cls, config: dict) -> None:
+        coroutines = [stream_name for stream_name, fn in config.items() if inspect.iscoroutinefunction(fn)]
+        if coroutines and not cls._awaits_processors:
+            raise ValueError(f"{cls.__name__} cannot await the processors of: {', '.join(coroutines)}, "
+                             f"run them with `app.start_async` or `AsyncMultiConsumer` instead")
+
+    # The first iteration always claims and catches up, after that it only happens every `claim_interval` ms
+    # which leaves the hot loop with a single blocking XREADGROUP.
+    def claim_is_due(self) -> bool:
+        if self._last_claim is None:
+            return True
+        return (time.monotonic() - self._last_claim) * 1000 >= self.claim_interval
+
+    def get_last_seen_id(self, stream_name: str) -> StreamID:
+        if stream_name not in self._checkpoints:
+            check_point_key = self._checkpoint_key(stream_name)
+            self._checkpoints[stream_name] = StreamID.parse(self.link.get(check_point_key) or b"0-0")
+        return self._checkpoints[stream_name]
+
+    def _remember_seen(self, messages: List[Tuple[str, str]]) -> None:
+        if self.seen_cache is None:
+            return
+        for stream, msg_uuid in messages:
+            self.seen_cache.add((self.group_name, stream, msg_uuid))
+
+    def _remember_checkpoint(self, stream_name: Union[str, bytes], stream_msg_id: StreamID) -> None:
+        if isinstance(stream_name, bytes):
+            stream_name = stream_name.decode("ascii")
+        current = self._checkpoints.get(stream_name)
+        if current is None or stream_msg_id > current:
+            self._checkpoints[stream_name] = stream_msg_id
+
+    # Whether `stream_msg_id` moves the checkpoint forward, checkpoints never move backwards
+    def _moves_checkpoint(self, stream_name: Union[str, bytes], stream_msg_id: StreamID) -> bool:
+        if isinstance(stream_name, bytes):
+            stream_name = stream_name.decode("ascii")
+        current = self._checkpoints.get(stream_name)
+        return current is None or stream_msg_id > current
+
+    # Whether acknowledgements write the checkpoint themselves
+    @property
+    def _write_checkpoints(self) -> bool:
+        return self._progress is None and self.checkpoint_interval is None
+
+    # Once a message has been acknowledged it becomes the checkpoint, unless the batch is worked on concurrently
+    def _acknowledged(self, stream_name: Union[str, bytes], stream_msg_id: StreamID) -> None:
+        if self._progress is not None:
+            self._progress.complete(stream_name, stream_msg_id)
+        elif self.checkpoint_interval is not None:
+            self._save_checkpoints({stream_name.decode("ascii") if isinstance(stream_name, bytes) else stream_name: stream_msg_id})
+        else:
+            self._remember_checkpoint(stream_name, stream_msg_id)
 
     # Multiple things are happening here.
     # 1. Save the stream_msg_id as checkpoint, which means
@@ -142,75 +517,506 @@ class MultiConsumer(object):
     # 2. Each message has a UUID and in order to process each meassage only once we remember
     #    the UUID for 14 days
     # 3. Acknowledge the message to meaning that we have processed it
-    def acknowledge(self, msg: Message, stream_msg_id: bytes) -> None:
+    def acknowledge(self, msg: Message, stream_msg_id: Union[StreamID, bytes, str], duplicate: bool = False) -> None:
+        stream_msg_id = StreamID.parse(stream_msg_id)
+        self._batch_acked.add((msg.stream, str(msg.msg_uuid)))
+        if self.batch_ack:
+            return self._buffer_ack(msg, stream_msg_id, duplicate)
+        self._acknowledge(msg, stream_msg_id, duplicate)
+
+    def _acknowledge(self, msg: Message, stream_msg_id: StreamID, duplicate: bool = False) -> None:
+        if self._ack_script is not None:
+            try:
+                return self._atomic_acknowledge(msg, stream_msg_id, duplicate)
+            except redis.exceptions.ResponseError as exc:
+                if not self._scripting_unavailable(exc):
+                    raise
+                log.warning(f"Group: '{self.group_name}' scripting is not available, falling back to pipelined acknowledgements", exc_info=True)
+                self._ack_script = None
         log.debug(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' acknowledging Message: {msg.msg_uuid} - {stream_msg_id}")
-        check_point_key = self._checkpoint_key(f"telstar:stream:{msg.stream}")
-        seen_key = self._seen_key(msg)
         # Execute the following statments in a transaction e.g. redis speak `pipeline`
         pipe = self.link.pipeline()
 
         # If this key changes before we execute the pipeline than the ack fails and this the processor reverts all the work.
         # Which is exactly what we want in this case as the work has already been completed by another consumer.
-        pipe.watch(seen_key)
+        watch_keys = self._ack_watch_keys(msg)
+        if watch_keys:
+            pipe.watch(*watch_keys)
+        self._queue_acknowledge(pipe, msg, stream_msg_id)
+        pipe.execute()
+        pipe.reset()
+        self._acknowledged(f"telstar:stream:{msg.stream}", stream_msg_id)
+        self._remember_seen([(msg.stream, str(msg.msg_uuid))])
+
+    def _ack_watch_keys(self, msg: Message) -> List[str]:
+        return self.seen_store.watch_keys(self.group_name, msg.stream, str(msg.msg_uuid))
+
+    def _queue_acknowledge(self, pipe: redis.client.Pipeline, msg: Message, stream_msg_id: StreamID) -> None:
         pipe.multi()
 
-        # Mark this as a seen key for 14 Days meaning if the message reappears after 14 days we reprocess it
-        pipe.set(seen_key, 1, ex=14 * 24 * 60 * 60)  # 14 days
+        # Mark this message as seen, by default for 14 Days meaning if the message reappears after 14 days we reprocess it
+        self.seen_store.mark(pipe, self.group_name, msg.stream, str(msg.msg_uuid))
 
         # Set the checkpoint for this consumer so that it knows where to start agains once it restarts.
-        pipe.set(check_point_key, stream_msg_id)
+        if self._write_checkpoints and self._moves_checkpoint(f"telstar:stream:{msg.stream}", stream_msg_id):
+            pipe.set(self._checkpoint_key(f"telstar:stream:{msg.stream}"), bytes(stream_msg_id))
 
         # Acknowledge the actual message
-        pipe.xack(f"telstar:stream:{msg.stream}", self.group_name, stream_msg_id)
-        pipe.execute()
-        pipe.reset()
+        pipe.xack(f"telstar:stream:{msg.stream}", self.group_name, bytes(stream_msg_id))
+
+    def _ack_script_keys(self, msg: Message) -> List[str]:
+        stream_name = f"telstar:stream:{msg.stream}"
+        return [self._seen_key(msg), self._checkpoint_key(stream_name), stream_name]
+
+    def _atomic_acknowledge(self, msg: Message, stream_msg_id: StreamID, duplicate: bool) -> None:
+        log.debug(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' atomically acknowledging Message: {msg.msg_uuid} - {stream_msg_id}")
+        fresh = self._ack_script(keys=self._ack_script_keys(msg), args=self._ack_script_args(stream_msg_id))
+        self._acknowledged(f"telstar:stream:{msg.stream}", stream_msg_id)
+        self._remember_seen([(msg.stream, str(msg.msg_uuid))])
+        if not fresh and not duplicate:
+            # Same as a failing WATCH, another consumer has completed the work in the meantime.
+            raise redis.exceptions.WatchError(f"Message: {msg.msg_uuid} has already been processed")
+
+    def _ack_script_args(self, stream_msg_id: StreamID) -> list:
+        return [self.group_name, bytes(stream_msg_id), self.seen_store.ttl, 1 if self._write_checkpoints else 0]
+
+    @staticmethod
+    def _scripting_unavailable(exc: redis.exceptions.ResponseError) -> bool:
+        return isinstance(exc, redis.exceptions.NoPermissionError) or "unknown command" in str(exc).lower()
+
+    def _buffer_ack(self, msg: Message, stream_msg_id: StreamID, duplicate: bool = False) -> None:
+        with self._ack_lock:
+            if not self._ack_buffer:
+                self._ack_buffer_started = time.monotonic()
+            self._ack_buffer.append((msg, stream_msg_id, duplicate))
+            elapsed = (time.monotonic() - self._ack_buffer_started) * 1000
+            if len(self._ack_buffer) >= self.batch_ack_size or elapsed >= self.batch_ack_timeout:
+                self.flush_acks()
+
+    # Same as `acknowledge` but for all buffered messages at once, this means
+    # 1. All messages are watched and marked as seen in one transaction
+    # 2. Only the last stream_msg_id per stream is written as checkpoint
+    # 3. Every stream gets a single XACK with all its ids
+    # Should any of the seen keys change in the meantime we fall back to acknowledging each message on its own
+    # so that only the messages that have been processed by another consumer fail, just like in `acknowledge`.
+    def flush_acks(self) -> None:
+        with self._ack_lock:
+            self._flush_acks()
+
+    def _flush_acks(self) -> None:
+        if not self._ack_buffer:
+            return
+        acks, self._ack_buffer = self._ack_buffer, []
+        log.debug(f"Group: '{self.group_name}' acknowledging {len(acks)} buffered message(s)")
+        self._acknowledge_many(acks)
+
+    def _acknowledge_many(self, acks: List[Tuple[Message, StreamID, bool]]) -> None:
+        if self._ack_script is not None:
+            try:
+                return self._atomic_acknowledge_many(acks)
+            except redis.exceptions.ResponseError as exc:
+                if not self._scripting_unavailable(exc):
+                    raise
+                log.warning(f"Group: '{self.group_name}' scripting is not available, falling back to pipelined acknowledgements", exc_info=True)
+                self._ack_script = None
 
-    def work(self, stream_name: bytes, stream_msg_id: bytes, record: Dict[bytes, bytes]) -> None:
+        seen = [(msg.stream, str(msg.msg_uuid)) for msg, _, _ in acks]
+        watch_keys = [key for stream, msg_uuid in seen for key in self.seen_store.watch_keys(self.group_name, stream, msg_uuid)]
+        checkpoints: Dict[str, StreamID] = dict()
+        stream_msg_ids: Dict[str, List[StreamID]] = defaultdict(list)
+        for msg, stream_msg_id, _ in acks:
+            stream_name = f"telstar:stream:{msg.stream}"
+            checkpoints[stream_name] = max(stream_msg_id, checkpoints.get(stream_name, stream_msg_id))
+            stream_msg_ids[stream_name].append(stream_msg_id)
+
+        pipe = self.link.pipeline()
         try:
-            msg = Message(stream_name,
-                          uuid.UUID(record[Message.IDFieldName].decode("ascii")),
-                          json.loads(record[Message.DataFieldName]))
-        except KeyError as exc:
-            msg = f"Malformed message, record: {record} does not have fields {Message.IDFieldName} and {Message.DataFieldName} "
-            log.exception(msg)
-            raise MessageError(msg) from exc
+            if watch_keys:
+                pipe.watch(*watch_keys)
+            pipe.multi()
+            for stream, msg_uuid in seen:
+                self.seen_store.mark(pipe, self.group_name, stream, msg_uuid)
+            if self._write_checkpoints:
+                for stream_name, stream_msg_id in checkpoints.items():
+                    if self._moves_checkpoint(stream_name, stream_msg_id):
+                        pipe.set(self._checkpoint_key(stream_name), bytes(stream_msg_id))
+            for stream_name, ids in stream_msg_ids.items():
+                pipe.xack(stream_name, self.group_name, *map(bytes, ids))
+            pipe.execute()
+            for msg, stream_msg_id, _ in acks:
+                self._acknowledged(f"telstar:stream:{msg.stream}", stream_msg_id)
+            self._remember_seen(seen)
+        except redis.exceptions.WatchError:
+            log.warning(f"Group: '{self.group_name}' seen keys changed while acknowledging, retrying {len(acks)} message(s) one by one")
+            self._acknowledge_each(acks)
+        finally:
+            pipe.reset()
+
+    # Every script call is atomic on its own, so there is no need for a transaction here. Just like in `acknowledge`
+    # a message that has been seen already, without being a double send, has been processed by another consumer in the
+    # meantime, which fails once all of them have been acknowledged.
+    def _atomic_acknowledge_many(self, acks: List[Tuple[Message, StreamID, bool]]) -> None:
+        pipe = self.link.pipeline(transaction=False)
+        for msg, stream_msg_id, _ in acks:
+            self._ack_script(keys=self._ack_script_keys(msg), args=self._ack_script_args(stream_msg_id), client=pipe)
+        error = None
+        for (msg, stream_msg_id, duplicate), fresh in zip(acks, pipe.execute()):
+            self._acknowledged(f"telstar:stream:{msg.stream}", stream_msg_id)
+            self._remember_seen([(msg.stream, str(msg.msg_uuid))])
+            if not fresh and not duplicate:
+                log.debug(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' Message: {msg.msg_uuid} - {stream_msg_id} had already been processed")
+                error = error or redis.exceptions.WatchError(f"Message: {msg.msg_uuid} has already been processed")
+        if error is not None:
+            raise error
+
+    def _acknowledge_each(self, acks: List[Tuple[Message, StreamID, bool]]) -> None:
+        error = None
+        for msg, stream_msg_id, duplicate in acks:
+            try:
+                self._acknowledge(msg, stream_msg_id, duplicate)
+            except redis.exceptions.WatchError as exc:
+                error = error or exc
+        if error is not None:
+            raise error
 
+    # `seen` can be passed in when the seen key has already been looked up, see `_seen_records`
+    def work(self, stream_name: bytes, stream_msg_id: StreamID, record: Dict[bytes, bytes], seen: Optional[bool] = None) -> None:
+        msg = self._message(stream_name, record)
         done = partial(self.acknowledge, msg, stream_msg_id)
-        key = self._seen_key(msg)
-        if self.link.get(key):
+        if seen is None:
+            [seen] = self._seen_records([(msg.stream, str(msg.msg_uuid))])
+        if seen:
             # This is a double send
             log.debug(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' skipping already processed Message: {msg.msg_uuid} - {stream_msg_id} ")
-            return done()
+            return done(duplicate=True)
 
         log.info(f"Stream: 'telstar:stream:{msg.stream}' in Group: '{self.group_name}' processing Message: {msg.msg_uuid} - {stream_msg_id}")
         self.processors[stream_name.decode("ascii")](self, msg, done)
 
+    def _message(self, stream_name: bytes, record: Dict[bytes, bytes]) -> Message:
+        try:
+            return Message.from_record(stream_name, record)
+        except MessageError as exc:
+            log.exception(str(exc))
+            raise
+
     # Process all message from `start`
     def catchup(self, streams: Dict[str, bytes]) -> int:
-        return self._xreadgroup(streams)
+        return sum(self._process(page) for page in self._pages(streams, self.catchup_page_size))
 
     # Process wait for new messages
     def read(self, streams: Dict[str, str], block: int) -> int:
         return self._xreadgroup(streams, block=block)
 
+    # Reads the given streams page by page, each page is requested only after the previous one has been
+    # consumed which keeps the memory bound by the page size rather than the size of the backlog.
+    # A stream is drained once it returns less than `count` records, until then we continue after
+    # the last id of the previous page (reading `>` simply continues with the next undelivered messages).
+    def _pages(self, streams: Dict[str, bytes], count: Optional[int]) -> Iterator[list]:
+        streams = dict(streams)
+        while streams:
+            page = self.link.xreadgroup(self.group_name, self.consumer_name, streams, count=count)
+            yield page
+            if count is None:
+                return
+            next_streams = dict()
+            for stream_name, records in page:
+                if len(records) < count:
+                    continue
+                if isinstance(stream_name, bytes):
+                    stream_name = stream_name.decode("ascii")
+                start = streams.get(stream_name)
+                next_streams[stream_name] = start if start in (">", b">") else records[-1][0]
+            streams = next_streams
+
     def _xreadgroup(self, streams: Dict[str, str], block: int = 0) -> int:
-        result = list()
-        for stream_name, records in self.link.xreadgroup(self.group_name, self.consumer_name, streams, block=block):
-            for record in records:
-                stream_msg_id, record = record
-                result.append((stream_name, stream_msg_id, record))
+        return self._process(self.link.xreadgroup(self.group_name, self.consumer_name, streams, block=block))
+
+    # The records of all streams in the order they where sent in. The records of each stream are already in order,
+    # so they are merged lazily by their ids rather than sorted. Within the same millisecond the ids of different
+    # streams say nothing about the order they were sent in - there the streams are merged by the producers and their
+    # sequence numbers instead. Messages of different producers in the same millisecond can only be ordered
+    # deterministically, not by when they were sent.
+    def _records(self, response: list) -> Iterator[Tuple[bytes, StreamID, Dict[bytes, bytes]]]:
+        streams = [self._stream_records(stream_name, records) for stream_name, records in response if records]
+        if len(streams) == 1:
+            return streams[0]
+        return self._in_sent_order(heapq.merge(*streams, key=itemgetter(1)))
+
+    # Merging needs a key each stream is sorted by, which only the ids are, so the records of a millisecond are merged
+    # again here. Only the ties between the streams are broken, each stream keeps the order of its ids.
+    @classmethod
+    def _in_sent_order(cls, records: Iterator[Tuple[bytes, StreamID, Dict[bytes, bytes]]]) -> Iterator[Tuple[bytes, StreamID, Dict[bytes, bytes]]]:
+        for _, same_ms in groupby(records, key=lambda t: t[1].ms):
+            runs: Dict[bytes, list] = {}
+            for t in same_ms:
+                runs.setdefault(t[0], []).append(t)
+            if len(runs) == 1:
+                yield from next(iter(runs.values()))
+            else:
+                yield from heapq.merge(*runs.values(), key=cls._sent_order)
 
+    @staticmethod
+    def _sent_order(t: Tuple[bytes, StreamID, Dict[bytes, bytes]]) -> Tuple[int, bytes, int]:
+        _, stream_msg_id, record = t
+        sequence = record.get(Message.SequenceFieldName)
+        if sequence is None:
+            return stream_msg_id.ms, b"", stream_msg_id.seq
+        return stream_msg_id.ms, record.get(Message.ProducerFieldName, b""), int(sequence)
+
+    # This is where the ids we read are parsed, from here on they are `StreamID`s
+    @staticmethod
+    def _stream_records(stream_name: bytes, records: list) -> Iterator[Tuple[bytes, StreamID, Dict[bytes, bytes]]]:
+        parse = StreamID.parse
+        for stream_msg_id, record in records:
+            yield stream_name, parse(stream_msg_id), record
+
+    def _process(self, response: list) -> int:
+        # The whole batch is needed for the lookup of the double sends
+        result = list(self._records(response))
         if not result:
             return 0
-        # Sort the message afterwards in order to restore the order they where sent in, this can only be a best effort
-        # approach and does not guarantee the correct order when using `xreadgroup` with multiple streams.
-        for processed, t in enumerate(sorted(result, key=lambda t: t[1]), start=1):
+        self.processed += len(result)
+        # The checkpoint must not move past messages that wait for their batch
+        progress = self._progress = BatchProgress(response) if self.max_workers > 1 or self._batch_processors else None
+        # Double sends are resolved for the whole batch upfront and never reach the processors.
+        messages = [self._record_seen(stream_name, record) for stream_name, _, record in result]
+        seen = self._seen_records(messages)
+        self._acknowledge_seen([t for t, is_seen in zip(result, seen) if is_seen])
+        # Double sends within the batch itself are only known once the first one has been acknowledged
+        self._batch_acked = set()
+        unseen = [(t, message) for t, message, is_seen in zip(result, messages, seen) if not is_seen]
+        unseen = self._buffer_batches(unseen)
+        try:
+            if progress is None:
+                self._work_in_order(unseen)
+            else:
+                self._work_concurrently(unseen)
+        finally:
+            # Whatever has been buffered needs to be flushed, even if we bail out of the batch
+            self.flush_acks()
+            if progress is not None:
+                self._progress = None
+                self._save_checkpoints(progress.checkpoints())
+        self._deliver_batches()
+        self.save_checkpoints()
+        return len(result)
+
+    # Takes the records of the streams of `BatchProcessor`s into their batches and returns the others.
+    # Records that are read again while they are waiting (e.g. when catching up) are only held once.
+    def _buffer_batches(self, records: List[Tuple[Tuple[bytes, StreamID, Dict[bytes, bytes]], Optional[Tuple[str, str]]]]) -> List[Tuple[Tuple[bytes, StreamID, Dict[bytes, bytes]], Optional[Tuple[str, str]]]]:
+        if not self._batch_processors:
+            return records
+        others = list()
+        for t, message in records:
             stream_name, stream_msg_id, record = t
+            processor = self.processors.get(stream_name.decode("ascii"))
+            if not isinstance(processor, BatchProcessor):
+                others.append((t, message))
+                continue
+            batch = self._batches[processor]
+            if not batch:
+                self._batch_started[processor] = time.monotonic()
+            batch[(stream_name, stream_msg_id)] = record
+        return others
+
+    def _batch_due(self, processor: BatchProcessor) -> bool:
+        batch = self._batches[processor]
+        if not batch:
+            return False
+        return len(batch) >= processor.max_batch or (time.monotonic() - self._batch_started[processor]) * 1000 >= processor.max_wait_ms
+
+    def _deliver_batches(self) -> None:
+        for processor in self._batch_processors:
+            batch = self._batches[processor]
+            while self._batch_due(processor):
+                keys = list(islice(batch, processor.max_batch))
+                self._work_batch(processor, [(stream_name, stream_msg_id, batch.pop((stream_name, stream_msg_id)))
+                                             for stream_name, stream_msg_id in keys])
+
+    # Hands a batch to its processor and acknowledges the successful messages in one go. Double sends within the
+    # batch are held back and acknowledged along with their first occurrence. The checkpoint only moves up to the
+    # last message of the batch all of whose predecessors have been processed as well.
+    def _work_batch(self, processor: BatchProcessor, records: List[Tuple[bytes, StreamID, Dict[bytes, bytes]]]) -> None:
+        response: Dict[bytes, list] = OrderedDict()
+        for stream_name, stream_msg_id, record in records:
+            response.setdefault(stream_name, []).append((stream_msg_id, record))
+        progress, previous = BatchProgress(list(response.items())), self._progress
+        self._progress = progress
+        try:
+            self._process_batch(processor, records)
+        finally:
+            self._progress = previous
+            self._save_checkpoints(progress.checkpoints())
+
+    def _process_batch(self, processor: BatchProcessor, records: List[Tuple[bytes, StreamID, Dict[bytes, bytes]]]) -> None:
+        msgs: List[Tuple[Message, StreamID]] = list()
+        first: Dict[Tuple[str, str], int] = dict()
+        twins: List[Tuple[Message, StreamID, Tuple[str, str]]] = list()
+        for stream_name, stream_msg_id, record in records:
             try:
-                self.work(stream_name, stream_msg_id, record)
+                msg = self._message(stream_name, record)
+                message = (msg.stream, str(msg.msg_uuid))
             except Exception as exc:
                 self._handle_exception(exc, stream_name, stream_msg_id, record)
-        return processed
+                continue
+            if message in first:
+                twins.append((msg, stream_msg_id, message))
+                continue
+            first[message] = len(msgs)
+            msgs.append((msg, stream_msg_id))
+        if not msgs:
+            return
+
+        streams = ", ".join(OrderedDict.fromkeys(f"telstar:stream:{msg.stream}" for msg, _ in msgs))
+        log.info(f"Stream: '{streams}' in Group: '{self.group_name}' processing a batch of {len(msgs)} message(s)")
+        results = processor(self, [msg for msg, _ in msgs])
+        if results is None:
+            results = [True] * len(msgs)
+        if len(results) != len(msgs):
+            raise ValueError(f"Group: '{self.group_name}' batch processor returned {len(results)} result(s) for {len(msgs)} message(s)")
+
+        failed = len(msgs) - sum(1 for success in results if success)
+        if failed:
+            log.warning(f"Stream: '{streams}' in Group: '{self.group_name}' {failed} message(s) of the batch failed and remain pending")
+        acks = [(msg, stream_msg_id, False) for (msg, stream_msg_id), success in zip(msgs, results) if success]
+        acks.extend((msg, stream_msg_id, True) for msg, stream_msg_id, message in twins if results[first[message]])
+        if acks:
+            with self._ack_lock:
+                self._acknowledge_many(acks)
+
+    def _work_in_order(self, records: List[Tuple[Tuple[bytes, StreamID, Dict[bytes, bytes]], Optional[Tuple[str, str]]]]) -> None:
+        for (stream_name, stream_msg_id, record), message in records:
+            try:
+                self.work(stream_name, stream_msg_id, record, seen=message in self._batch_acked)
+            except Exception as exc:
+                self._handle_exception(exc, stream_name, stream_msg_id, record)
+
+    # Each partition is worked on in order by one of the threads of the pool, should a message fail without
+    # being handled the rest of its partition is left for later and the first error is raised once all are done.
+    def _work_concurrently(self, records: List[Tuple[Tuple[bytes, StreamID, Dict[bytes, bytes]], Optional[Tuple[str, str]]]]) -> None:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix=f"telstar-{self.group_name}")
+        partitions: Dict[Hashable, list] = OrderedDict()
+        for t, message in records:
+            partitions.setdefault(self._partition(t, message), []).append((t, message))
+        futures = [self._pool.submit(self._work_in_order, partition) for partition in partitions.values()]
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def _partition(self, t: Tuple[bytes, StreamID, Dict[bytes, bytes]], message: Optional[Tuple[str, str]]) -> Hashable:
+        stream_name, stream_msg_id, record = t
+        if self.partition_key is None or message is None:
+            # Malformed messages are on their own
+            return message or stream_msg_id
+        try:
+            msg = self._message(stream_name, record)
+            key = self.partition_key(msg) if callable(self.partition_key) else msg.data.get(self.partition_key)
+            hash(key)
+        except (MessageError, ValueError, AttributeError, TypeError):
+            # Whatever is wrong with the message is raised by `work`, where the error handlers get to see it
+            return stream_msg_id
+        return key
+
+    # Checkpoints are only ever moved forward, a batch may complete after messages that have been read later.
+    # With `checkpoint_interval` they are only remembered here and written by `save_checkpoints`.
+    def _save_checkpoints(self, checkpoints: Dict[str, StreamID]) -> None:
+        checkpoints = {stream_name: stream_msg_id for stream_name, stream_msg_id in checkpoints.items()
+                       if stream_name not in self._checkpoints or stream_msg_id > self._checkpoints[stream_name]}
+        if not checkpoints:
+            return
+        for stream_name, stream_msg_id in checkpoints.items():
+            self._remember_checkpoint(stream_name, stream_msg_id)
+        self._unsaved_checkpoints.update(checkpoints)
+        if self.checkpoint_interval is None:
+            self.save_checkpoints(force=True)
+
+    # Writes the checkpoints that have moved since they have last been written, unless that has been less than
+    # `checkpoint_interval` ms ago. All of them are written in a single round trip.
+    def save_checkpoints(self, force: bool = False) -> None:
+        if not self._unsaved_checkpoints:
+            return
+        if not force and (time.monotonic() - self._checkpoints_saved) * 1000 < (self.checkpoint_interval or 0):
+            return
+        checkpoints, self._unsaved_checkpoints = self._unsaved_checkpoints, dict()
+        pipe = self.link.pipeline()
+        for stream_name, stream_msg_id in checkpoints.items():
+            pipe.set(self._checkpoint_key(stream_name), bytes(stream_msg_id))
+        try:
+            pipe.execute()
+        except Exception:
+            # Try again next time, unless they have moved on in the meantime
+            self._unsaved_checkpoints = {**checkpoints, **self._unsaved_checkpoints}
+            raise
+        self._checkpoints_saved = time.monotonic()
+        log.debug(f"Stream: '{', '.join(checkpoints)}' in Group: '{self.group_name}' saved checkpoints")
+
+    # The (stream, uuid) a record is remembered by in the seen store
+    def _record_seen(self, stream_name: bytes, record: Dict[bytes, bytes]) -> Optional[Tuple[str, str]]:
+        try:
+            msg = Message.from_record(stream_name, record)
+            msg_uuid = msg.msg_uuid
+        except (MessageError, ValueError):
+            # Malformed messages are left to `work` to complain about
+            return None
+        return msg.stream, str(msg_uuid)
+
+    # Look up whether the messages have been seen for the whole batch at once instead of once per message.
+    def _seen_records(self, messages: List[Optional[Tuple[str, str]]]) -> List[bool]:
+        lookup, cached = self._split_cached(messages)
+        seen = dict(zip(lookup, self.seen_store.seen(self.link, self.group_name, lookup))) if lookup else dict()
+        seen.update(dict.fromkeys(cached, True))
+        return [bool(seen.get(message)) for message in messages]
+
+    # Splits the messages into the ones we need to look up and the ones the seen cache knows about
+    def _split_cached(self, messages: List[Optional[Tuple[str, str]]]) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+        lookup, cached = list(), list()
+        for message in messages:
+            if message is None:
+                continue
+            if self._cached_seen(message):
+                cached.append(message)
+            else:
+                lookup.append(message)
+        return lookup, cached
+
+    def _cached_seen(self, message: Tuple[str, str]) -> bool:
+        return self.seen_cache is not None and self.seen_cache.seen((self.group_name, *message))
+
+    # Acknowledge double sends in bulk: they are marked as seen once more, just like
+    # `acknowledge` would do, and every stream gets a single XACK and checkpoint.
+    def _acknowledge_seen(self, records: List[Tuple[bytes, StreamID, Dict[bytes, bytes]]]) -> None:
+        if not records:
+            return
+        pipe = self.link.pipeline()
+        stream_msg_ids, seen = self._queue_acknowledge_seen(pipe, records)
+        pipe.execute()
+        self._remember_acknowledged_seen(stream_msg_ids, seen)
+
+    def _queue_acknowledge_seen(self, pipe: redis.client.Pipeline, records: List[Tuple[bytes, StreamID, Dict[bytes, bytes]]]) -> Tuple[Dict[bytes, List[StreamID]], List[Tuple[str, str]]]:
+        checkpoints: Dict[bytes, StreamID] = dict()
+        stream_msg_ids: Dict[bytes, List[StreamID]] = defaultdict(list)
+        seen = [self._record_seen(stream_name, record) for stream_name, _, record in records]
+        for (stream_name, stream_msg_id, record), (stream, msg_uuid) in zip(records, seen):
+            self.seen_store.touch(pipe, self.group_name, stream, msg_uuid)
+            checkpoints[stream_name] = max(stream_msg_id, checkpoints.get(stream_name, stream_msg_id))
+            stream_msg_ids[stream_name].append(stream_msg_id)
+        if self._write_checkpoints:
+            for stream_name, stream_msg_id in checkpoints.items():
+                if self._moves_checkpoint(stream_name, stream_msg_id):
+                    pipe.set(self._checkpoint_key(stream_name.decode("ascii")), bytes(stream_msg_id))
+        for stream_name, ids in stream_msg_ids.items():
+            pipe.xack(stream_name, self.group_name, *map(bytes, ids))
+        return stream_msg_ids, seen
+
+    def _remember_acknowledged_seen(self, stream_msg_ids: Dict[bytes, List[StreamID]], seen: List[Tuple[str, str]]) -> None:
+        for stream_name, ids in stream_msg_ids.items():
+            for stream_msg_id in ids:
+                self._acknowledged(stream_name, stream_msg_id)
+        self._remember_seen(seen)
+        log.debug(f"Group: '{self.group_name}' skipped {len(seen)} already processed message(s)")
 
     def _find_error_handler(self, exc):
         for cls in type(exc).__mro__:
@@ -228,12 +1034,19 @@ class MultiConsumer(object):
         return handler(exc, bare_ack, record)
 
     def _bare_ack(self, stream_name, stream_msg_id):
+        # Keep the checkpoints in order with what has been buffered before
+        self.flush_acks()
+        stream_msg_id = StreamID.parse(stream_msg_id)
+        if isinstance(stream_name, bytes):
+            stream_name = stream_name.decode("ascii")
         check_point_key = self._checkpoint_key(stream_name)
         pipe = self.link.pipeline()
 
-        pipe.set(check_point_key, stream_msg_id)
-        pipe.xack(stream_name, self.group_name, stream_msg_id)
+        if self._write_checkpoints and self._moves_checkpoint(stream_name, stream_msg_id):
+            pipe.set(check_point_key, bytes(stream_msg_id))
+        pipe.xack(stream_name, self.group_name, bytes(stream_msg_id))
         pipe.execute()
+        self._acknowledged(stream_name, stream_msg_id)
 
 
 class Consumer(MultiConsumer):
@@ -278,11 +1091,11 @@ class MultiConsumeOnce(MultiConsumer):
             # Which does two things first it puts them all into the pending list of that consumer inside the group
             # and also delivers them to the client.
             streams = {s: ">" for s in self.streams}
-            num_processed = self.read(streams, 0)
+            num_processed = self.catchup(streams)
         else:
             # Now the data as already been delivered to the group we can now start reading from the beginning
             streams = {s: "0" for s in self.streams}
-            num_processed = self.read(streams, 0)
+            num_processed = self.catchup(streams)
 
         # everything has been seen and processed where can mark this as applied
         if not self.has_pending_message():
@@ -311,12 +1124,23 @@ class ThreadedMultiConsumer:
         for group_name, config in group_configs.items():
             self.consumers.append(MultiConsumer(link, group_name, consumer_name, config, **kw))
 
+    # The consumers run in daemon threads which are dropped on shutdown without closing them, so the checkpoints they
+    # have not saved yet are saved here. SIGTERM shuts down like Ctrl-C unless there is a handler for it already.
     def run(self):
-        self._run_threaded("run")
+        if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _exit_on_sigterm)
+        try:
+            self._run_threaded("run")
+        finally:
+            self.close()
 
     def run_once(self) -> None:
         self._run_threaded("run_once")
 
+    def close(self) -> None:
+        for c in self.consumers:
+            c.close()
+
     def _run_threaded(self, target: str) -> None:
         threads = list()
         for c in self.consumers:
@@ -326,3 +1150,165 @@ class ThreadedMultiConsumer:
 
         for t in threads:
             t.join()
+
+
+# The state of a single consumer process as seen by `ProcessMultiConsumer`
+class WorkerStatus:
+    def __init__(self, group_name: str, consumer_name: str, config: dict) -> None:
+        self.group_name = group_name
+        self.consumer_name = consumer_name
+        self.config = config
+        self.process: Optional[multiprocessing.Process] = None
+        self.pid: Optional[int] = None
+        self.processed = 0
+        self.restarts = 0
+        # Consecutive crashes, reset as soon as the worker completes an iteration
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.last_seen: Optional[float] = None
+        self.restart_at: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.group_name}:{self.consumer_name}"
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def as_dict(self) -> dict:
+        return dict(group=self.group_name, consumer=self.consumer_name, pid=self.pid, alive=self.alive,
+                    processed=self.processed, restarts=self.restarts, last_error=self.last_error)
+
+
+# `ProcessMultiConsumer.stop` terminates the workers, which lets them close their consumer on the way out
+def _exit_on_sigterm(signum, frame) -> None:
+    raise SystemExit(0)
+
+
+def _consume_in_process(link: redis.Redis, group_name: str, consumer_name: str, config: dict, kw: dict,
+                        status: multiprocessing.Queue, once: bool) -> None:
+    name = f"{group_name}:{consumer_name}"
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        consumer = MultiConsumer(link, group_name, consumer_name, config, **kw)
+        status.put((name, "started", os.getpid()))
+        try:
+            while True:
+                processed = consumer.processed
+                consumer.run_once()
+                status.put((name, "processed", consumer.processed - processed))
+                if once:
+                    return
+        finally:
+            consumer.close()
+    except Exception as exc:
+        log.exception(f"Group: '{group_name}' as Consumer: '{consumer_name}' crashed")
+        status.put((name, "failed", repr(exc)))
+        sys.exit(1)
+
+
+# Same as `ThreadedMultiConsumer` but every group runs in a process of its own, which keeps CPU bound processors
+# from serializing on the GIL. With `replicas` a group is run by several processes at once, each with a consumer
+# name of its own `{consumer_name}-{i}` - either the same number for all groups or a dict of group name to replicas.
+# Crashed processes are restarted after `restart_backoff` ms, doubling with every consecutive crash up to
+# `max_restart_backoff` ms, and the workers report back to the parent, see `status`.
+# The processes are forked so the processors don't need to be picklable, this is not available on Windows.
+class ProcessMultiConsumer:
+    def __init__(self, link: redis.Redis, consumer_name: str, group_configs: dict, replicas: Union[int, Dict[str, int]] = 1,
+                 restart_backoff: int = 1000, max_restart_backoff: int = 60 * 1000, **kw) -> None:
+        self.link = link
+        self.kw = kw
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self._context = multiprocessing.get_context("fork")
+        self._status = self._context.Queue()
+        self.workers: Dict[str, WorkerStatus] = dict()
+        for group_name, config in group_configs.items():
+            MultiConsumer._check_processors(config)
+            count = replicas.get(group_name, 1) if isinstance(replicas, dict) else replicas
+            for i in range(count):
+                worker = WorkerStatus(group_name, consumer_name if count == 1 else f"{consumer_name}-{i}", config)
+                self.workers[worker.name] = worker
+
+    def run(self) -> None:
+        for worker in self.workers.values():
+            self._start(worker)
+        try:
+            while True:
+                self.supervise()
+        finally:
+            self.stop()
+
+    # Every worker runs `run_once` a single time, should any of them crash we raise once all of them are done
+    def run_once(self) -> None:
+        for worker in self.workers.values():
+            self._start(worker, once=True)
+        # Keep reading the reports while waiting, a worker can't exit while its reports are stuck in a full pipe
+        while any(worker.alive for worker in self.workers.values()):
+            self._collect_status(0.1)
+        for worker in self.workers.values():
+            worker.process.join()
+        self._collect_status()
+        failed = [worker for worker in self.workers.values() if worker.process.exitcode != 0]
+        if failed:
+            raise RuntimeError("Consumer(s) crashed: " + ", ".join(f"{worker.name} ({worker.last_error})" for worker in failed))
+
+    # Collects the status reports and restarts workers that have died, waits at most `timeout` seconds for reports
+    def supervise(self, timeout: float = 1.0) -> None:
+        self._collect_status(timeout)
+        now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.alive:
+                continue
+            if worker.restart_at is None:
+                worker.failures += 1
+                backoff = min(self.restart_backoff * 2 ** (worker.failures - 1), self.max_restart_backoff)
+                worker.restart_at = now + backoff / 1000
+                log.warning(f"Group: '{worker.group_name}' as Consumer: '{worker.consumer_name}' exited with {worker.process.exitcode}, restarting in {backoff}ms")
+            elif now >= worker.restart_at:
+                worker.restarts += 1
+                self._start(worker)
+
+    def stop(self) -> None:
+        for worker in self.workers.values():
+            if worker.alive:
+                worker.process.terminate()
+        for worker in self.workers.values():
+            if worker.process is not None:
+                worker.process.join()
+
+    # The status of each worker together with the totals over all of them
+    def status(self) -> dict:
+        self._collect_status()
+        workers = [worker.as_dict() for worker in self.workers.values()]
+        return dict(workers=workers,
+                    alive=sum(1 for worker in workers if worker["alive"]),
+                    processed=sum(worker["processed"] for worker in workers),
+                    restarts=sum(worker["restarts"] for worker in workers))
+
+    def _start(self, worker: WorkerStatus, once: bool = False) -> None:
+        worker.restart_at = None
+        worker.process = self._context.Process(target=_consume_in_process, name=worker.name, daemon=True,
+                                               args=(self.link, worker.group_name, worker.consumer_name, worker.config,
+                                                     self.kw, self._status, once))
+        worker.process.start()
+        worker.pid = worker.process.pid
+
+    def _collect_status(self, timeout: Optional[float] = None) -> None:
+        while True:
+            try:
+                if timeout:
+                    name, event, value = self._status.get(timeout=timeout)
+                    timeout = None
+                else:
+                    name, event, value = self._status.get_nowait()
+            except queue.Empty:
+                return
+            worker = self.workers[name]
+            worker.last_seen = time.monotonic()
+            if event == "processed":
+                worker.processed += value
+                worker.failures = 0
+            elif event == "failed":
+                worker.last_error = value
@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import redis
+
+log = logging.getLogger(__name__)
+
+# Seen keys are kept for 14 days, meaning if the message reappears after 14 days we reprocess it
+SEEN_KEY_TTL = 14 * 24 * 60 * 60
+
+DAY = 24 * 60 * 60
+
+
+# A seen store remembers which messages a consumer group has already processed.
+# Messages are identified by the (stripped) stream name and their uuid as string.
+# Lookups are done for a whole batch at once, marks are queued on a pipeline so they
+# become part of the transaction that acknowledges the messages.
+# Stores only ever queue commands on pipelines, which lets them work with `redis.asyncio` as well.
+class SeenStore:
+    def seen(self, link: redis.Redis, group: str, messages: Sequence[Tuple[str, str]]) -> List[bool]:
+        if not messages:
+            return []
+        pipe = link.pipeline(transaction=False)
+        found = self.lookup(pipe, group, messages)
+        return found(pipe.execute())
+
+    # Queues the lookup on `pipe` and returns a function that turns the results of the pipeline into a bool per message
+    def lookup(self, pipe: redis.client.Pipeline, group: str, messages: Sequence[Tuple[str, str]]) -> Callable[[list], List[bool]]:
+        raise NotImplementedError
+
+    def mark(self, pipe: redis.client.Pipeline, group: str, stream: str, msg_uuid: str, now: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    # Called for double sends, which are marked again by default
+    def touch(self, pipe: redis.client.Pipeline, group: str, stream: str, msg_uuid: str) -> None:
+        self.mark(pipe, group, stream, msg_uuid)
+
+    # Keys to WATCH while acknowledging, a change of these makes the acknowledgement fail
+    def watch_keys(self, group: str, stream: str, msg_uuid: str) -> List[str]:
+        return []
+
+
+# One key with a TTL for each message, `telstar:seen:{stream}:{group}:{uuid}`.
+# Simple and exact, but the per key overhead adds up with tens of millions of messages.
+class SeenKeys(SeenStore):
+    def __init__(self, ttl: int = SEEN_KEY_TTL) -> None:
+        self.ttl = ttl
+
+    def key(self, group: str, stream: str, msg_uuid: str) -> str:
+        return f"telstar:seen:{stream}:{group}:{msg_uuid}"
+
+    def lookup(self, pipe: redis.client.Pipeline, group: str, messages: Sequence[Tuple[str, str]]) -> Callable[[list], List[bool]]:
+        pipe.mget([self.key(group, stream, msg_uuid) for stream, msg_uuid in messages])
+        return lambda results: [bool(value) for value in results[0]]
+
+    def mark(self, pipe: redis.client.Pipeline, group: str, stream: str, msg_uuid: str, now: Optional[float] = None) -> None:
+        ttl = self.ttl
+        if now is not None:
+            ttl -= int(time.time() - now)
+        pipe.set(self.key(group, stream, msg_uuid), 1, ex=max(ttl, 1))
+
+    def touch(self, pipe: redis.client.Pipeline, group: str, stream: str, msg_uuid: str) -> None:
+        pipe.expire(self.key(group, stream, msg_uuid), self.ttl)
+
+    def watch_keys(self, group: str, stream: str, msg_uuid: str) -> List[str]:
+        return [self.key(group, stream, msg_uuid)]
+
+
+# Base for stores that put messages into one bucket per day, per stream and group. Buckets expire
+# as a whole `retention_days` after their day has passed and a lookup checks all buckets within the retention.
+# As a bucket is shared by all messages of a day its key is not WATCHed, the lookup before processing is what
+# keeps the messages from being processed twice.
+# With `legacy` the per message keys of `SeenKeys` are checked as well, which allows switching stores while the old
+# keys are still around, see also `migrate_seen_keys`.
+class DailySeenStore(SeenStore):
+    prefix = None
+
+    def __init__(self, retention_days: int = 14, legacy: bool = False) -> None:
+        self.retention_days = retention_days
+        self.legacy = SeenKeys() if legacy else None
+
+    def key(self, group: str, stream: str, day: str) -> str:
+        return f"{self.prefix}:{stream}:{group}:{day}"
+
+    def day(self, now: float) -> str:
+        return time.strftime("%Y%m%d", time.gmtime(now))
+
+    def days(self, now: Optional[float] = None) -> List[str]:
+        now = time.time() if now is None else now
+        return [self.day(now - i * DAY) for i in range(self.retention_days + 1)]
+
+    def expire_at(self, now: float) -> int:
+        return int((now // DAY + 1 + self.retention_days) * DAY)
+
+    def lookup(self, pipe: redis.client.Pipeline, group: str, messages: Sequence[Tuple[str, str]]) -> Callable[[list], List[bool]]:
+        uuids: Dict[str, List[str]] = defaultdict(list)
+        for stream, msg_uuid in messages:
+            uuids[stream].append(msg_uuid)
+
+        lookups = list()
+        for stream, msg_uuids in uuids.items():
+            for day in self.days():
+                self._lookup(pipe, self.key(group, stream, day), msg_uuids)
+                lookups.append((stream, msg_uuids))
+        if self.legacy is not None:
+            pipe.mget([self.legacy.key(group, stream, msg_uuid) for stream, msg_uuid in messages])
+
+        def found(results: list) -> List[bool]:
+            hits = set()
+            for (stream, msg_uuids), result in zip(lookups, results):
+                hits.update((stream, msg_uuid) for msg_uuid, hit in zip(msg_uuids, self._hits(result, len(msg_uuids))) if hit)
+            if self.legacy is not None:
+                hits.update(message for message, value in zip(messages, results[len(lookups)]) if value)
+            return [message in hits for message in messages]
+        return found
+
+    def mark(self, pipe: redis.client.Pipeline, group: str, stream: str, msg_uuid: str, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        key = self.key(group, stream, self.day(now))
+        self._mark(pipe, key, msg_uuid)
+        pipe.expireat(key, self.expire_at(now))
+
+    def _lookup(self, pipe: redis.client.Pipeline, key: str, msg_uuids: List[str]) -> None:
+        raise NotImplementedError
+
+    def _hits(self, result, count: int) -> List[bool]:
+        raise NotImplementedError
+
+    def _mark(self, pipe: redis.client.Pipeline, key: str, msg_uuid: str) -> None:
+        raise NotImplementedError
+
+
+# Exact, the uuids are fields of one hash per day which is far more compact than a key per message.
+class SeenBuckets(DailySeenStore):
+    prefix = "telstar:seen-buckets"
+
+    def _lookup(self, pipe: redis.client.Pipeline, key: str, msg_uuids: List[str]) -> None:
+        pipe.hmget(key, msg_uuids)
+
+    def _hits(self, result, count: int) -> List[bool]:
+        return [bool(value) for value in result]
+
+    def _mark(self, pipe: redis.client.Pipeline, key: str, msg_uuid: str) -> None:
+        pipe.hset(key, msg_uuid, 1)
+
+
+# A bloom filter on a plain redis bitmap per day, sized for `capacity` messages a day at a false positive rate
+# of `error_rate`. A false positive means a message is skipped although it has never been processed, so choose
+# the rate accordingly. The bits are read and written with BITFIELD which takes all offsets in one command.
+class SeenBloom(DailySeenStore):
+    prefix = "telstar:seen-bloom"
+
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.001, retention_days: int = 14, legacy: bool = False) -> None:
+        super().__init__(retention_days, legacy)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+
+    def offsets(self, msg_uuid: str) -> List[int]:
+        # Double hashing, uuids are not necessarily random (e.g. uuid1) so we hash them first
+        digest = hashlib.blake2b(msg_uuid.encode("ascii"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _lookup(self, pipe: redis.client.Pipeline, key: str, msg_uuids: List[str]) -> None:
+        args = list()
+        for msg_uuid in msg_uuids:
+            for offset in self.offsets(msg_uuid):
+                args.extend(("GET", "u1", offset))
+        pipe.execute_command("BITFIELD", key, *args)
+
+    def _hits(self, result, count: int) -> List[bool]:
+        return [all(result[i * self.hashes:(i + 1) * self.hashes]) for i in range(count)]
+
+    def _mark(self, pipe: redis.client.Pipeline, key: str, msg_uuid: str) -> None:
+        args = list()
+        for offset in self.offsets(msg_uuid):
+            args.extend(("SET", "u1", offset, 1))
+        pipe.execute_command("BITFIELD", key, *args)
+
+
+# A bounded in process cache of the messages this consumer has acknowledged itself, which saves the round trip
+# to redis when the same messages come along again (e.g. while claiming and replaying the history).
+# It only ever answers "seen", a miss always falls through to the seen store, so it can't cause a message to be
+# processed twice. Entries are evicted least recently used first and after `ttl` seconds, which should stay well
+# below the retention of the seen store.
+class SeenCache:
+    def __init__(self, maxsize: int = 100000, ttl: Optional[float] = 60 * 60) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def seen(self, key: Hashable) -> bool:
+        with self._lock:
+            added = self._entries.get(key)
+            if added is not None and self.ttl is not None and time.monotonic() - added > self.ttl:
+                del self._entries[key]
+                added = None
+            if added is None:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries[key] = time.monotonic()
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+
+# Moves the per message keys of `SeenKeys` for the given stream and group into `store`.
+# Each message goes into the bucket of the day it was seen on, which we derive from the remaining ttl of its key.
+# With `delete` the migrated keys are removed. Returns the number of migrated keys.
+def migrate_seen_keys(link: redis.Redis, store: SeenStore, stream: str, group: str, delete: bool = False,
+                      count: int = 1000, ttl: int = SEEN_KEY_TTL) -> int:
+    prefix = SeenKeys().key(group, stream, "")
+    migrated = 0
+    keys = list()
+    for key in link.scan_iter(match=f"{prefix}*", count=count):
+        keys.append(key)
+        if len(keys) >= count:
+            migrated += _migrate(link, store, stream, group, prefix, keys, delete, ttl)
+            keys = list()
+    if keys:
+        migrated += _migrate(link, store, stream, group, prefix, keys, delete, ttl)
+    log.info(f"Stream: '{stream}' in Group: '{group}' migrated {migrated} seen key(s)")
+    return migrated
+
+
+def _migrate(link: redis.Redis, store: SeenStore, stream: str, group: str, prefix: str, keys: List[bytes], delete: bool, ttl: int) -> int:
+    pipe = link.pipeline(transaction=False)
+    for key in keys:
+        pipe.ttl(key)
+    remaining = pipe.execute()
+
+    now = time.time()
+    migrated = 0
+    pipe = link.pipeline(transaction=False)
+    for key, key_ttl in zip(keys, remaining):
+        # -2 means the key has expired in the meantime
+        if key_ttl == -2:
+            continue
+        seen_at = now - (ttl - key_ttl) if key_ttl >= 0 else now
+        store.mark(pipe, group, stream, key.decode("ascii")[len(prefix):], now=seen_at)
+        if delete:
+            pipe.delete(key)
+        migrated += 1
+    pipe.execute()
+    return migrated
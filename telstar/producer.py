@@ -1,36 +1,61 @@
-import json
 import logging
-from time import sleep
-from typing import Callable, List, Optional, Tuple
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple, Union
 
 from redis.client import Redis
 
-from .com import Message
+from .com import Codec, Message
 from .config import staging
 
 log = logging.getLogger(__name__)
 
 
+# A block without a transaction around it, `contextlib.nullcontext` needs Python 3.7
+@contextmanager
+def _no_transaction():
+    yield
+
+
 class Producer(object):
-    def __init__(self, link: Redis, get_records: Callable[[], Tuple[List[Message], Callable[[], None]]], context_callable: Optional[Callable] = None) -> None:
+    # `codec` is what the data of the messages is encoded with, see `telstar.com.codecs`.
+    # Every message carries the `name` of its producer and a sequence number that counts up with each message
+    # the producer sends, which is how consumers order messages of several streams sent in the same millisecond.
+    # With `max_pipeline_size` the messages are sent in pipelines of at most that many messages.
+    def __init__(self, link: Redis, get_records: Callable[[], Tuple[List[Message], Callable[[], None]]], context_callable: Optional[Callable] = None,
+                 codec: Optional[Codec] = None, name: Optional[str] = None, max_pipeline_size: Optional[int] = None) -> None:
         self.link = link
         self.get_records = get_records
         self.context_callable = context_callable
+        self.codec = codec
+        self.name = name or uuid.uuid4().hex
+        self.sequence = 0
+        self.max_pipeline_size = max_pipeline_size
 
+    # The messages are sent in MULTI/EXEC, within it the ids redis assigns only ever increase so the messages
+    # of a stream are in the order of `records` without having to wait between them.
     def run_once(self) -> None:
         records, done = self.get_records()
-        pipe = self.link.pipeline()
-        for msg in records:
-            # Why the sleep here? It helps with sorting the events on the receiving side.
-            # But it also limits to amount of possible sends to under 1k messages per send.
-            # Which for now seems acceptable.
-            sleep(.001)
-            pipe.xadd(f"telstar:stream:{msg.stream}", {
-                      Message.IDFieldName: str(msg.msg_uuid),
-                      Message.DataFieldName: json.dumps(msg.data)})
-        pipe.execute()
+        size = self.max_pipeline_size or len(records) or 1
+        for i in range(0, len(records), size):
+            pipe = self.link.pipeline()
+            for msg in records[i:i + size]:
+                self.sequence += 1
+                content_type, data = msg.encode(self.codec)
+                pipe.xadd(f"telstar:stream:{msg.stream}", {
+                          Message.IDFieldName: str(msg.msg_uuid),
+                          Message.DataFieldName: data,
+                          Message.ContentTypeFieldName: content_type,
+                          Message.ProducerFieldName: self.name,
+                          Message.SequenceFieldName: self.sequence})
+            pipe.execute()
         done()
 
+    # Called between two runs outside of the `context_callable`
+    def pause(self) -> None:
+        pass
+
     def run(self):
         log.info("Starting main producer loop")
         while True:
@@ -39,30 +64,122 @@ class Producer(object):
                     self.run_once()
             else:
                 self.run_once()
+            self.pause()
 
 
+# Sends the messages staged in the database. It starts out with pulling `batch_size` messages at a time, while the
+# pulls keep coming back full the batch size doubles up to `max_batch_size` and the next pull follows right away.
+# Once a pull is not full the batch size halves again down to `batch_size` and we wait for `wait` seconds, every
+# pull that comes back empty doubles the wait up to `max_wait` seconds.
+# With `claim` the messages are claimed from the table, which allows several producers to send from the same table
+# without sending messages twice. `True` locks the rows with SKIP LOCKED where the database supports it and leases
+# them for `lease` seconds where it does not, `"skip_locked"` and `"lease"` pick one of them, see `StagedMessage.claim`.
+# Leases have to be seen by the other producers before the messages are sent, so with leases there is no transaction
+# around the whole of `run_once`, the leases are taken and the messages marked as sent in short transactions of their
+# own. With SQLAlchemy this needs a session with `autocommit=True`, as `get_transaction_wrapper` already does.
+# Should sending fail the leases are given up again.
 class StagedProducer(Producer):
-    def __init__(self, link: Redis, database, batch_size: int = 5, wait: float = 0.5) -> None:
+    def __init__(self, link: Redis, database, batch_size: int = 5, wait: float = 0.5, codec: Optional[Codec] = None,
+                 max_batch_size: int = 1000, max_wait: float = 5.0, max_pipeline_size: Optional[int] = 500,
+                 claim: Union[bool, str] = False, lease: float = 30.0) -> None:
+        if claim not in (False, True, "skip_locked", "lease"):
+            raise ValueError(f"claim needs to be a bool, 'skip_locked' or 'lease' not {claim!r}")
+        self.claim = claim
+        self.lease = lease
         self.batch_size = batch_size
         self.wait = wait
+        self.max_batch_size = max(max_batch_size, batch_size)
+        self.max_wait = max(max_wait, wait)
+        self.current_batch_size = batch_size
+        self.current_wait = 0.0
+        # The messages sent so far and how many messages a second we have sent lately
+        self.sent = 0
+        self.drain_rate = 0.0
+        self._last_pull: Optional[float] = None
+        # While draining a backlog we page through it by id, see `pull`
+        self._after_id: Optional[int] = None
         staging.repository.setup(database)
+        self.leases = claim == "lease" or (claim is True and not staging.repository.supports_skip_locked())
+        self._leased: list = []
 
-        super().__init__(link, self.create_puller(), staging.repository.get_transaction_wrapper())
+        context_callable = _no_transaction if self.leases else staging.repository.get_transaction_wrapper()
+        super().__init__(link, self.create_puller(), context_callable, codec=codec, max_pipeline_size=max_pipeline_size)
 
     def create_puller(self) -> Callable:
         producer = self
 
         def puller() -> Tuple[List[Message], Callable[[], None]]:
-            unsent_messages = staging.repository.unsent()[:producer.batch_size]
+            unsent_messages = producer.pull(producer.current_batch_size)
             telstar_messages = [msg.to_telstar() for msg in unsent_messages]
             log.debug(f"Found {len(telstar_messages)} messages to be send")
 
             def done():
                 if unsent_messages:
                     log.debug(f"Attempting to mark {len(unsent_messages)} messages as being sent")
-                    result = staging.repository.mark_as_sent(unsent_messages)
+                    with producer._lease_transaction():
+                        result = staging.repository.mark_as_sent(unsent_messages)
+                    producer._leased = []
                     log.debug(f"Result was: {result}")
-                sleep(producer.wait)
+                # Only keep paging while the pulls come back full, the next pull after a short one starts over
+                # so messages whose `send_at` has come by now are picked up even if they have been staged earlier.
+                full = bool(unsent_messages) and len(unsent_messages) >= producer.current_batch_size
+                producer._after_id = unsent_messages[-1].id if full else None
+                producer.adapt(len(unsent_messages))
 
             return telstar_messages, done
         return puller
+
+    def pull(self, limit: int) -> list:
+        if not self.claim:
+            return staging.repository.unsent(after_id=self._after_id)[:limit]
+        if not self.leases:
+            return staging.repository.claim(limit, self.name, skip_locked=True)
+        # No transaction around the claim, its UPDATE only takes the leases that are still free and commits on its own.
+        # Reading the free rows inside the same transaction has two producers on SQLite lock each other out.
+        self._leased = staging.repository.claim(limit, self.name, lease=self.lease, skip_locked=False)
+        return self._leased
+
+    def run_once(self) -> None:
+        try:
+            super().run_once()
+        except Exception:
+            self.release()
+            raise
+
+    # Gives up the leases of the messages that have been claimed but not sent
+    def release(self) -> None:
+        leased, self._leased = self._leased, []
+        if leased:
+            with self._lease_transaction():
+                staging.repository.release(leased)
+
+    def _lease_transaction(self):
+        return staging.repository.get_transaction_wrapper()() if self.leases else _no_transaction()
+
+    # Adjusts the batch size and the wait to how many messages the last pull returned
+    def adapt(self, count: int) -> None:
+        if count >= self.current_batch_size:
+            self.current_batch_size = min(self.current_batch_size * 2, self.max_batch_size)
+            self.current_wait = 0.0
+        elif count:
+            self.current_batch_size = max(self.current_batch_size // 2, self.batch_size)
+            self.current_wait = self.wait
+        else:
+            self.current_wait = min(max(self.current_wait * 2, self.wait), self.max_wait)
+
+        now = time.monotonic()
+        if self._last_pull is not None and now > self._last_pull:
+            # A moving average over the last few pulls, waits included
+            rate = count / (now - self._last_pull)
+            self.drain_rate = rate if not self.sent else 0.8 * self.drain_rate + 0.2 * rate
+        self._last_pull = now
+        self.sent += count
+
+    def pause(self) -> None:
+        if self.current_wait:
+            time.sleep(self.current_wait)
+
+    # `backlog` is the number of messages that are due to be sent, which takes a query to find out
+    def metrics(self) -> dict:
+        return dict(backlog=staging.repository.unsent().count(), drain_rate=self.drain_rate, sent=self.sent,
+                    batch_size=self.current_batch_size, wait=self.current_wait)
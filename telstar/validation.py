@@ -0,0 +1,49 @@
+import threading
+import time
+from typing import Any, Dict, List, Tuple, Type, Union
+
+from marshmallow import Schema, ValidationError
+
+# Loads the data of the messages for one handler of `telstar.app`. Constructing a marshmallow schema is far more
+# expensive than loading a message with it, so the schema is instantiated once and reused for every message.
+# Keeps track of how many messages have been loaded, how many of them were invalid and how long that took.
+
+
+class Validator:
+    def __init__(self, schema: Union[Type[Schema], Schema]) -> None:
+        self.schema: Schema = schema() if isinstance(schema, type) else schema
+        self.loaded = 0
+        self.invalid = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def load(self, data: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            loaded = self.schema.load(data)
+        except ValidationError:
+            self._count(1, 1, start)
+            raise
+        self._count(1, 0, start)
+        return loaded
+
+    # Loads the data of a batch of messages at once, returns the loaded data and the errors by the index of the invalid
+    # messages instead of raising so the valid messages of the batch can still be processed.
+    def load_many(self, data: List[Any]) -> Tuple[List[Any], Dict[int, Any]]:
+        start = time.perf_counter()
+        try:
+            loaded, errors = self.schema.load(data, many=True), dict()
+        except ValidationError as err:
+            loaded, errors = err.valid_data, err.messages
+        self._count(len(data), len(errors), start)
+        return loaded, errors
+
+    def _count(self, loaded: int, invalid: int, start: float) -> None:
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.loaded += loaded
+            self.invalid += invalid
+            self.seconds += elapsed
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return dict(loaded=self.loaded, invalid=self.invalid, time_ms=self.seconds * 1000)
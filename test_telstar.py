@@ -1,7 +1,12 @@
+import asyncio
+import math
 import os
+import signal
+import threading
 import uuid
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import List
 from unittest import mock
 
 import peewee
@@ -11,15 +16,18 @@ import pymysql
 from marshmallow import Schema, ValidationError, fields
 from playhouse.db_url import connect
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import StatementError
 
 import telstar
 from telstar import config as tlconfig
-from telstar.com import Message, MessageError
+from telstar.aio import AsyncMultiConsumer, async_link
+from telstar.com import Message, MessageError, StreamID, codecs, decrement_msg_id, increment_msg_id
 from telstar.com.pw import StagedMessage as StagedMessagePeeWee
 from telstar.com.sqla import StagedMessageRepository as StagedMessageSqlAlchemy
-from telstar.consumer import Consumer, MultiConsumeOnce, MultiConsumer
+from telstar.consumer import (BatchProcessor, BatchProgress, Consumer, MultiConsumeOnce, MultiConsumer, Prefetcher, ProcessMultiConsumer,
+                              ThreadedMultiConsumer)
+from telstar.dedup import SeenBloom, SeenBuckets, SeenCache, SeenKeys, migrate_seen_keys
 from telstar.producer import StagedProducer
 
 pymysql.install_as_MySQLdb()
@@ -50,6 +58,19 @@ def reallink() -> redis.Redis:
     return client
 
 
+@pytest.fixture
+def asynclink(reallink) -> redis.asyncio.Redis:
+    return redis.asyncio.from_url(os.environ.get("REDIS", "redis://localhost:6379/10"))
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
 def peewee_db_setup(connection_uri):
     tables = [tlconfig.staging.repository]
     db = connect(connection_uri)
@@ -115,6 +136,34 @@ def db_session(session_maker) -> peewee.Database:
         session.close()
 
 
+# A database in a file of its own, which unlike the one in memory is shared by the connections of several threads.
+# Sessions are in autocommit mode, so that producers can run their own transactions.
+@pytest.fixture
+def outbox_database(tmp_path, db_engine):
+    path = str(tmp_path / "outbox.db")
+    if os.environ.get("ORM") == "peewee":
+        database = peewee.SqliteDatabase(path)
+        database.bind([StagedMessagePeeWee])
+        database.create_tables([StagedMessagePeeWee])
+
+        yield database
+
+        StagedMessagePeeWee.bind(db_engine)
+        database.close()
+
+    if os.environ.get("ORM") == "sqlalchemy":
+        from telstar.com.sqla import Base
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(engine)
+        session = scoped_session(sessionmaker(bind=engine, autocommit=True))
+        tlconfig.staging.repository.setup(session)
+
+        yield session
+
+        session.remove()
+        engine.dispose()
+
+
 @pytest.fixture
 def consumer(link) -> Consumer:
     return Consumer(link, "mygroup", "myname", "mytopic", lambda msg, done: done())
@@ -126,6 +175,25 @@ def test_message():
     assert m.msg_uuid == uid
 
 
+def test_message_from_record_decodes_lazily(mocker):
+    uid = uuid.uuid4()
+    loads = mocker.spy(codecs, "decode")
+    m = Message.from_record(b"telstar:stream:topic", {Message.IDFieldName: str(uid).encode("ascii"),
+                                                      Message.DataFieldName: b'{"a": 1}'})
+    assert m.stream == "topic"
+    assert m.raw == b'{"a": 1}'
+    assert not loads.called
+    assert m.data == {"a": 1}
+    assert m.msg_uuid == uid
+    assert not hasattr(m, "__dict__")
+
+    m.data = {"a": 2}
+    assert m.raw == b'{"a": 2}'
+
+    with pytest.raises(MessageError):
+        Message.from_record(b"topic", {Message.IDFieldName: str(uid).encode("ascii")})
+
+
 def test_consumer_create_group(link):
     Consumer(link, "mygroup", "myname", "mytopic", lambda msg, done: done())
     link.xgroup_create.assert_called_once_with('telstar:stream:mytopic', 'mygroup', id='0', mkstream=True)
@@ -136,7 +204,7 @@ def test_consumer_run(link: redis.Redis):
     msg_id = str(uuid.uuid4()).encode("ascii")
     link.get.return_value = None
     link.xreadgroup.return_value = [[
-        b"telstar:stream:mytopic", [["stream_msg_id", {b'message_id': msg_id, b"data": "{}"}]]
+        b"telstar:stream:mytopic", [[b"1-0", {b'message_id': msg_id, b"data": "{}"}]]
     ]]
     c = Consumer(link, "mygroup", "myname", "mytopic", callback)
     c.transfer_and_process_stream_history = lambda *a, **kw: None
@@ -158,7 +226,7 @@ def test_consumer_run_callback(link: redis.Redis):
 
     link.get.return_value = None
     link.xreadgroup.return_value = [[
-        b"telstar:stream:mytopic", [["stream_msg_id", {b'message_id': msg_id, b"data": "{}"}]]
+        b"telstar:stream:mytopic", [[b"1-0", {b'message_id': msg_id, b"data": "{}"}]]
     ]]
     c = Consumer(link, "mygroup", "myname", "mytopic", callback)
     c.transfer_and_process_stream_history = lambda *a, **kw: None
@@ -177,12 +245,53 @@ def test_consumer_checkpoint(link: redis.Redis):
     pipeline = mock.MagicMock(spec=redis.client.Pipeline)()
     link.pipeline.return_value = pipeline
     link.xreadgroup.return_value = [[
-        b"telstar:stream:mytopic", [["stream_msg_id", {b'message_id': msg_id, b"data": "{}"}]]
+        b"telstar:stream:mytopic", [[b"1-0", {b'message_id': msg_id, b"data": "{}"}]]
     ]]
     c = Consumer(link, "mygroup", "myname", "mytopic", callback)
     c.run_once()
-    link.get.assert_any_call("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname")
-    pipeline.set.assert_called_with("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname", "stream_msg_id")
+    checkpoint_key = "telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname"
+    link.get.assert_any_call(checkpoint_key)
+    # The message is read once when catching up and once more as a new one, the checkpoint is written once
+    assert [call for call in pipeline.set.call_args_list if call[0][0] == checkpoint_key] == [mock.call(checkpoint_key, b"1-0")]
+
+
+def test_consumer_coalesces_checkpoints(link: redis.Redis):
+    checkpoint_key = "telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname"
+    link.get.return_value = None
+    pipeline = mock.MagicMock(spec=redis.client.Pipeline)()
+    link.pipeline.return_value = pipeline
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [[f"1-{i}".encode("ascii"), {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": "{}"}]
+                                    for i in range(3)]
+    ]]
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": lambda c, msg, done: done()}, checkpoint_interval=0)
+    c.transfer_and_process_stream_history = lambda *a, **kw: None
+    c.run_once()
+    assert [call for call in pipeline.set.call_args_list if call[0][0] == checkpoint_key] == [mock.call(checkpoint_key, b"1-2")]
+
+    # Acknowledging out of order never moves the checkpoint back
+    pipeline.reset_mock()
+    c.checkpoint_interval = 60 * 1000
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), b"1-1")
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), b"2-0")
+    c.save_checkpoints()
+    assert not [call for call in pipeline.set.call_args_list if call[0][0] == checkpoint_key]
+    c.close()
+    assert [call for call in pipeline.set.call_args_list if call[0][0] == checkpoint_key] == [mock.call(checkpoint_key, b"2-0")]
+    assert c.get_last_seen_id("telstar:stream:mytopic") == StreamID(2, 0)
+
+
+def test_consumer_checkpoints_only_move_forward(link: redis.Redis):
+    checkpoint_key = "telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname"
+    pipeline = mock.MagicMock(spec=redis.client.Pipeline)()
+    link.pipeline.return_value = pipeline
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": mock.Mock()})
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), b"2-0")
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), b"1-1")
+    c._bare_ack("telstar:stream:mytopic", b"1-0")
+    assert [call for call in pipeline.set.call_args_list if call[0][0] == checkpoint_key] == [mock.call(checkpoint_key, b"2-0")]
+    assert pipeline.xack.call_count == 3
+    assert c.get_last_seen_id("telstar:stream:mytopic") == StreamID(2, 0)
 
 
 def test_consumer_with_multiple_stearms(link):
@@ -197,11 +306,11 @@ def test_consumer_with_multiple_stearms(link):
     link.get.return_value = None
     link.xreadgroup.return_value = [
         [b"telstar:stream:mytopic1", [
-            ["stream_msg_id1", {b'message_id': msg_id, b"data": "{}"}],
-            ["stream_msg_id2", {b'message_id': msg_id, b"data": "{}"}]
+            [b"1-0", {b'message_id': msg_id, b"data": "{}"}],
+            [b"1-1", {b'message_id': msg_id, b"data": "{}"}]
         ]],
 
-        [b"telstar:stream:mytopic2", [["stream_msg_id", {b'message_id': msg_id, b"data": "{}"}]]]
+        [b"telstar:stream:mytopic2", [[b"1-2", {b'message_id': msg_id, b"data": "{}"}]]]
     ]
 
     mc = MultiConsumer(link, "group", "name", config)
@@ -212,6 +321,369 @@ def test_consumer_with_multiple_stearms(link):
     assert callback2.call_count == 1
 
 
+def test_consumer_merges_streams_by_parsed_id(link: redis.Redis):
+    order = []
+    config = {"mytopic1": lambda c, msg, done: order.append(msg.data["i"]),
+              "mytopic2": lambda c, msg, done: order.append(msg.data["i"])}
+
+    def record(i):
+        return {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": f'{{"i": {i}}}'}
+
+    link.xreadgroup.return_value = [
+        [b"telstar:stream:mytopic1", [[b"999-5", record(0)], [b"1000-1", record(2)], [b"10000-0", record(4)]]],
+        [b"telstar:stream:mytopic2", [[b"1000-0", record(1)], [b"9999-9", record(3)]]],
+    ]
+    mc = MultiConsumer(link, "group", "name", config)
+    mc.transfer_and_process_stream_history = lambda *a, **kw: None
+    mc.run_once()
+
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_consumer_orders_same_millisecond_by_producer_sequence(link: redis.Redis):
+    order = []
+    config = {"mytopic1": lambda c, msg, done: order.append(msg.data["i"]),
+              "mytopic2": lambda c, msg, done: order.append(msg.data["i"])}
+
+    def record(i):
+        return {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": f'{{"i": {i}}}',
+                Message.ProducerFieldName: b"p1", Message.SequenceFieldName: str(i + 1).encode("ascii")}
+
+    link.xreadgroup.return_value = [
+        [b"telstar:stream:mytopic1", [[b"1000-0", record(1)], [b"1000-1", record(2)]]],
+        [b"telstar:stream:mytopic2", [[b"1000-0", record(0)], [b"1000-1", record(3)]]],
+    ]
+    mc = MultiConsumer(link, "group", "name", config)
+    mc.transfer_and_process_stream_history = lambda *a, **kw: None
+    mc.run_once()
+
+    assert order == [0, 1, 2, 3]
+
+
+def test_consumer_orders_same_millisecond_of_several_producers(link: redis.Redis):
+    order = []
+    config = {"mytopic1": lambda c, msg, done: order.append(msg.data["i"]),
+              "mytopic2": lambda c, msg, done: order.append(msg.data["i"])}
+
+    def record(producer, sequence):
+        return {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": f'{{"i": "{producer}#{sequence}"}}',
+                Message.ProducerFieldName: producer.encode("ascii"), Message.SequenceFieldName: str(sequence).encode("ascii")}
+
+    link.xreadgroup.return_value = [
+        [b"telstar:stream:mytopic1", [[b"1000-0", record("p1", 2)]]],
+        [b"telstar:stream:mytopic2", [[b"1000-0", record("p1", 1)], [b"1000-1", record("p2", 1)], [b"1001-0", record("p2", 2)]]],
+    ]
+    mc = MultiConsumer(link, "group", "name", config)
+    mc.transfer_and_process_stream_history = lambda *a, **kw: None
+    mc.run_once()
+
+    assert order == ["p1#1", "p1#2", "p2#1", "p2#2"]
+
+    # Within a stream the records keep the order of their ids whatever else has been read
+    order.clear()
+    link.xreadgroup.return_value = [
+        [b"telstar:stream:mytopic1", [[b"5-0", record("zz", 1)], [b"5-1", record("aa", 1)]]],
+        [b"telstar:stream:mytopic2", [[b"5-0", record("mm", 1)]]],
+    ]
+    mc.run_once()
+
+    assert order == ["mm#1", "zz#1", "aa#1"]
+
+
+def test_stream_id():
+    stream_msg_id = StreamID.parse(b"1560032216285-12")
+    assert stream_msg_id == StreamID(1560032216285, 12) == StreamID.parse("1560032216285-12")
+    assert StreamID.parse(stream_msg_id) is stream_msg_id
+    assert bytes(stream_msg_id) == b"1560032216285-12" and str(stream_msg_id) == "1560032216285-12"
+    assert StreamID.parse("999-0") < StreamID.parse("1000-0")
+    assert min(StreamID.parse_many([b"1000-0", b"999-1", b"999-0"])) == StreamID(999, 0)
+    assert len({StreamID.parse(b"1-0"), StreamID.parse("1-0")}) == 1
+    assert StreamID.parse(b"5").seq == 0
+    assert stream_msg_id.next() == StreamID(1560032216285, 13)
+    assert increment_msg_id(b"1-0") == b"1-1"
+    assert decrement_msg_id(b"2-0") == b"1-0"
+    assert decrement_msg_id(b"2-1") == b"2-0"
+
+
+def test_consumer_batch_ack(link: redis.Redis):
+    msg_id1, msg_id2 = [str(uuid.uuid4()).encode("ascii") for _ in range(2)]
+
+    def callback(c, msg: Message, done):
+        done()
+
+    link.get.return_value = None
+    pipeline = mock.MagicMock(spec=redis.client.Pipeline)()
+    link.pipeline.return_value = pipeline
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [
+            [b"1-0", {b'message_id': msg_id1, b"data": "{}"}],
+            [b"1-1", {b'message_id': msg_id2, b"data": "{}"}]
+        ]
+    ]]
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": callback}, batch_ack=True)
+    c.transfer_and_process_stream_history = lambda *a, **kw: None
+    c.run_once()
+
+    # One for the seen lookup, one for the acknowledgements
+    assert pipeline.execute.call_count == 2
+    pipeline.xack.assert_called_once_with("telstar:stream:mytopic", "mygroup", b"1-0", b"1-1")
+    pipeline.set.assert_called_with("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname", b"1-1")
+
+
+def test_consumer_batch_ack_flushes_on_size(link: redis.Redis):
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": mock.Mock()}, batch_ack=True, batch_ack_size=2)
+    pipeline = link.pipeline.return_value
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), "1-0")
+    pipeline.execute.assert_not_called()
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), "1-1")
+    pipeline.execute.assert_called_once()
+
+
+def test_consumer_batch_ack_falls_back_on_watch_error(link: redis.Redis):
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": mock.Mock()}, batch_ack=True)
+    pipeline = link.pipeline.return_value
+    # The batch and the first message conflict, the second one goes through
+    pipeline.execute.side_effect = [redis.exceptions.WatchError(), redis.exceptions.WatchError(), None]
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), "1-0")
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), "1-1")
+
+    with pytest.raises(redis.exceptions.WatchError):
+        c.flush_acks()
+    assert pipeline.execute.call_count == 3
+    pipeline.xack.assert_called_with("telstar:stream:mytopic", "mygroup", b"1-1")
+
+
+def test_consumer_skips_seen_messages_in_bulk(link: redis.Redis):
+    callback = mock.Mock()
+    seen_id, unseen_id = [str(uuid.uuid4()).encode("ascii") for _ in range(2)]
+    pipeline = link.pipeline.return_value
+    pipeline.execute.return_value = [[b"1", None]]
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [
+            ["1-0", {b'message_id': seen_id, b"data": "{}"}],
+            ["1-1", {b'message_id': unseen_id, b"data": "{}"}]
+        ]
+    ]]
+    c = Consumer(link, "mygroup", "myname", "mytopic", callback)
+    c.transfer_and_process_stream_history = lambda *a, **kw: None
+    c.run_once()
+
+    pipeline.mget.assert_called_once_with([f"telstar:seen:mytopic:mygroup:{seen_id.decode()}",
+                                           f"telstar:seen:mytopic:mygroup:{unseen_id.decode()}"])
+    link.get.assert_not_called()
+    pipeline.xack.assert_called_once_with(b"telstar:stream:mytopic", "mygroup", b"1-0")
+    [(_, msg, _)] = [c.args for c in callback.call_args_list]
+    assert msg.msg_uuid == uuid.UUID(unseen_id.decode())
+
+
+def test_consumer_skips_double_sends_within_a_batch(link: redis.Redis):
+    processed = list()
+
+    def callback(consumer, msg, done):
+        processed.append(msg.msg_uuid)
+        done()
+
+    msg_id = str(uuid.uuid4()).encode("ascii")
+    link.mget.return_value = [None, None]
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [
+            ["1-0", {b'message_id': msg_id, b"data": "{}"}],
+            ["1-1", {b'message_id': msg_id, b"data": "{}"}]
+        ]
+    ]]
+    c = Consumer(link, "mygroup", "myname", "mytopic", callback)
+    c.transfer_and_process_stream_history = lambda *a, **kw: None
+    c.run_once()
+
+    assert processed == [uuid.UUID(msg_id.decode())]
+
+
+def test_consumer_catchup_in_pages(link: redis.Redis):
+    callback = mock.Mock()
+
+    def record(stream_msg_id):
+        return [stream_msg_id, {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": "{}"}]
+
+    link.xreadgroup.side_effect = [
+        [[b"telstar:stream:mytopic", [record(b"1-0"), record(b"1-1")]]],
+        [[b"telstar:stream:mytopic", [record(b"2-0"), record(b"2-1")]]],
+        [[b"telstar:stream:mytopic", [record(b"3-0")]]],
+    ]
+    c = Consumer(link, "mygroup", "myname", "mytopic", callback)
+    c.catchup_page_size = 2
+
+    assert c.catchup({"telstar:stream:mytopic": b"0-0"}) == 5
+    assert callback.call_count == 5
+    assert [call.args[2] for call in link.xreadgroup.call_args_list] == [
+        {"telstar:stream:mytopic": b"0-0"},
+        {"telstar:stream:mytopic": b"1-1"},
+        {"telstar:stream:mytopic": b"2-1"},
+    ]
+    link.xreadgroup.assert_called_with("mygroup", "myname", {"telstar:stream:mytopic": b"2-1"}, count=2)
+
+
+def test_consumer_autoclaim_pages(link: redis.Redis):
+    link.xautoclaim.side_effect = [
+        [b"2-0", [(b"1-0", {b"data": b"{}"}), (b"1-1", None)]],
+        [b"0-0", [(b"2-0", {b"data": b"{}"})], []],
+    ]
+    c = Consumer(link, "mygroup", "myname", "mytopic", mock.Mock())
+    c.autoclaim, c.claim_page_size = True, 2
+
+    assert c.claim_message_from_the_dead("telstar:stream:mytopic") == [StreamID(1, 0), StreamID(2, 0)]
+    link.xautoclaim.assert_called_with("telstar:stream:mytopic", "mygroup", "myname", 20 * 1000, start_id=b"2-0", count=2)
+    link.xpending.assert_not_called()
+
+
+def test_consumer_process_claimed(link: redis.Redis):
+    callback = mock.Mock()
+    msg_id = str(uuid.uuid4()).encode("ascii")
+    link.xpending_range.side_effect = [[{"message_id": b"1-0"}, {"message_id": b"1-1"}], [{"message_id": b"2-0"}]]
+    link.xclaim.side_effect = [[(b"1-0", {b'message_id': msg_id, b"data": b"{}"})], []]
+    link.get.return_value = None
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": callback}, process_claimed=True, claim_page_size=2)
+    c.transfer_and_process_stream_history(c.streams)
+
+    assert callback.call_count == 1
+    link.xpending_range.assert_called_with("telstar:stream:mytopic", "mygroup", b"1-2", "+", 2)
+    link.xclaim.assert_called_with("telstar:stream:mytopic", "mygroup", "myname", 20 * 1000, [b"2-0"])
+    # There is no replaying the history from the checkpoint
+    link.xreadgroup.assert_not_called()
+
+
+def test_consumer_process_claimed_keeps_checkpoint(link: redis.Redis):
+    checkpoint_key = "telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname"
+    pipeline = mock.MagicMock(spec=redis.client.Pipeline)()
+    link.pipeline.return_value = pipeline
+    link.get.return_value = b"100-0"
+    msg_id = str(uuid.uuid4()).encode("ascii")
+    link.xpending_range.side_effect = [[{"message_id": b"5-0"}], []]
+    link.xclaim.side_effect = [[(b"5-0", {b'message_id': msg_id, b"data": b"{}"})]]
+    callback = mock.Mock(side_effect=lambda consumer, msg, done: done())
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": callback}, process_claimed=True, claim_page_size=2)
+    c.transfer_and_process_stream_history(c.streams)
+
+    assert callback.call_count == 1
+    pipeline.xack.assert_called_once()
+    assert not [call for call in pipeline.set.call_args_list if call[0][0] == checkpoint_key]
+    assert c.get_last_seen_id("telstar:stream:mytopic") == StreamID(100, 0)
+
+
+def test_consumer_claims_on_interval(link: redis.Redis):
+    c = Consumer(link, "mygroup", "myname", "mytopic", mock.Mock())
+    c.transfer_and_process_stream_history = mock.Mock()
+    assert c.claim_interval == 10 * 1000
+    c.run_once()
+    c.run_once()
+    assert c.transfer_and_process_stream_history.call_count == 1
+
+    c.claim_interval = 0
+    c.run_once()
+    assert c.transfer_and_process_stream_history.call_count == 2
+
+
+def test_consumer_keeps_checkpoint_in_memory(link: redis.Redis):
+    link.get.return_value = b"1-0"
+    c = Consumer(link, "mygroup", "myname", "mytopic", mock.Mock())
+    assert c.get_last_seen_id("telstar:stream:mytopic") == StreamID(1, 0)
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), b"2-0")
+    assert c.get_last_seen_id("telstar:stream:mytopic") == StreamID(2, 0)
+    link.get.assert_called_once_with("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname")
+
+
+def test_consumer_atomic_ack(link: redis.Redis):
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": mock.Mock()}, atomic_ack=True)
+    script = link.register_script.return_value
+    script.return_value = 1
+    msg = Message("mytopic", uuid.uuid4(), {})
+    c.acknowledge(msg, "1-0")
+    script.assert_called_once_with(keys=[c._seen_key(msg),
+                                         "telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname",
+                                         "telstar:stream:mytopic"], args=["mygroup", b"1-0", 14 * 24 * 60 * 60, 1])
+    link.pipeline.assert_not_called()
+
+    script.return_value = 0
+    with pytest.raises(redis.exceptions.WatchError):
+        c.acknowledge(msg, "1-0")
+
+
+def test_consumer_atomic_batch_ack(link: redis.Redis):
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": mock.Mock()}, atomic_ack=True, batch_ack=True, batch_ack_size=10)
+    pipeline = link.pipeline.return_value
+    msg, twin, other = Message("mytopic", uuid.uuid4(), {}), Message("mytopic", uuid.uuid4(), {}), Message("mytopic", uuid.uuid4(), {})
+    c.acknowledge(msg, "1-0")
+    c.acknowledge(twin, "1-1", duplicate=True)
+    pipeline.execute.return_value = [1, 0]
+    c.flush_acks()
+    link.pipeline.assert_called_with(transaction=False)
+
+    # Another consumer has processed the message in the meantime, all the same it is acknowledged
+    c.acknowledge(msg, "2-0")
+    c.acknowledge(other, "2-1")
+    pipeline.execute.return_value = [1, 0]
+    with pytest.raises(redis.exceptions.WatchError):
+        c.flush_acks()
+    assert c._ack_buffer == []
+    assert c.get_last_seen_id("telstar:stream:mytopic") == StreamID(2, 1)
+
+
+def test_consumer_atomic_ack_falls_back_to_pipeline(link: redis.Redis):
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": mock.Mock()}, atomic_ack=True)
+    link.register_script.return_value.side_effect = redis.exceptions.ResponseError("unknown command 'EVALSHA'")
+    c.acknowledge(Message("mytopic", uuid.uuid4(), {}), "1-0")
+    link.pipeline.return_value.xack.assert_called_once_with("telstar:stream:mytopic", "mygroup", b"1-0")
+    assert c._ack_script is None
+
+
+def test_seen_bloom_sizing():
+    bloom = SeenBloom(capacity=1000, error_rate=0.01)
+    assert bloom.bits == 9586
+    assert bloom.hashes == 7
+    offsets = bloom.offsets(str(uuid.uuid4()))
+    assert len(offsets) == 7
+    assert all(0 <= offset < bloom.bits for offset in offsets)
+
+
+def test_seen_buckets_expire_after_retention():
+    store = SeenBuckets(retention_days=2)
+    now = datetime(2020, 6, 1, 13, 0, tzinfo=timezone.utc).timestamp()
+    assert store.days(now) == ["20200601", "20200531", "20200530"]
+    assert store.expire_at(now) == datetime(2020, 6, 4, tzinfo=timezone.utc).timestamp()
+
+
+def test_seen_cache():
+    cache = SeenCache(maxsize=2)
+    cache.add("a")
+    cache.add("b")
+    assert cache.seen("a")
+    cache.add("c")  # evicts b as a has been used more recently
+    assert not cache.seen("b")
+    assert cache.seen("c")
+    assert cache.stats() == dict(hits=2, misses=1, size=2)
+
+    cache = SeenCache(ttl=0)
+    cache.add("a")
+    time.sleep(0.01)
+    assert not cache.seen("a")
+
+
+def test_consumer_seen_cache_short_circuits_lookup(link: redis.Redis):
+    callback = mock.Mock()
+    msg_id = str(uuid.uuid4()).encode("ascii")
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [["1-0", {b'message_id': msg_id, b"data": "{}"}]]
+    ]]
+    cache = SeenCache()
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": callback}, seen_cache=cache)
+    c.acknowledge(Message("mytopic", uuid.UUID(msg_id.decode("ascii")), {}), "1-0")
+    assert cache.seen(("mygroup", "mytopic", msg_id.decode("ascii")))
+
+    c.catchup({"telstar:stream:mytopic": "0-0"})
+    callback.assert_not_called()
+    link.pipeline.return_value.mget.assert_not_called()
+    assert cache.hits == 2
+
+
 def test_seen_key(consumer: Consumer):
     uid_hex = "752884c3f7284cf19d3b9940373685f4"
     uid = uuid.UUID(uid_hex)
@@ -249,6 +721,46 @@ def test_staged_event(db_session):
     assert len(tlconfig.staging.repository.select().where(tlconfig.staging.repository.topic == "mytopic")) == 1
 
 
+def test_stage_many(db_session, link):
+    uids = telstar.stage_many([("mytopic", dict(a=i)) for i in range(3)] + [("othertopic", dict(b=1))])
+    assert len(set(uids)) == 4
+
+    staged, done = StagedProducer(link, db_session, batch_size=10).get_records()
+    assert sorted((m.stream, m.msg_uuid) for m in staged) == sorted(zip(["mytopic"] * 3 + ["othertopic"], uids))
+    assert sorted(m.data.get("a", -1) for m in staged) == [-1, 0, 1, 2]
+    done()
+    assert telstar.staged() == []
+
+
+def test_staged_producer_pages_by_id(db_session, link):
+    telstar.stage_many([("mytopic", dict(a=i)) for i in range(5)])
+    producer = StagedProducer(link, db_session, batch_size=2)
+
+    pulled = list()
+    for _ in range(3):
+        staged, done = producer.get_records()
+        pulled.append([m.data["a"] for m in staged])
+        done()
+    assert pulled == [[0, 1], [2, 3, 4], []]
+    assert producer._after_id is None
+
+
+def test_purge_sent(outbox_database, link):
+    telstar.stage_many([("mytopic", dict(a=i)) for i in range(5)], delay=-3600)
+    telstar.stage("mytopic", dict(a=5), delay=60)
+    _, done = StagedProducer(link, outbox_database, batch_size=10).get_records()
+    done()
+
+    # Due long ago but only just sent
+    assert telstar.purge_sent(older_than=60) == 0
+    time.sleep(0.01)
+    archived = list()
+    assert telstar.purge_sent(older_than=0, chunk_size=2, archive=lambda rows: archived.append(len(rows))) == 5
+    assert archived == [2, 2, 1]
+    assert telstar.purge_sent(older_than=0) == 0
+    assert tlconfig.staging.repository.unsent(after_id=0).count() == 0
+
+
 def test_staged_producer(db_session, link):
     telstar.stage("mytopic", dict(a=1))
     [msgs], _ = StagedProducer(link, db_session).get_records()
@@ -288,6 +800,103 @@ def test_staged_producer_done_callback_removes_staged_events(db_session, link):
     assert len(telstar.staged()) == 1
 
 
+def test_staged_producer_adapts_to_backlog(db_session, link):
+    for i in range(7):
+        telstar.stage("mytopic", dict(i=i))
+    producer = StagedProducer(link, db_session, batch_size=2, max_batch_size=4, wait=0.5, max_wait=0.75, max_pipeline_size=3)
+    assert producer.metrics()["backlog"] == 7
+
+    steps = list()
+    for _ in range(5):
+        producer.run_once()
+        steps.append((producer.current_batch_size, producer.current_wait))
+    assert steps == [(4, 0), (4, 0), (2, 0.5), (2, 0.75), (2, 0.75)]
+    # The batch of 4 is sent in two pipelines
+    assert link.pipeline.call_count == 4
+
+    metrics = producer.metrics()
+    assert metrics["backlog"] == 0
+    assert metrics["sent"] == 7
+    assert metrics["drain_rate"] > 0
+
+
+def test_staged_producers_claim_rows(outbox_database, link):
+    for i in range(5):
+        telstar.stage_many([("mytopic", dict(i=i))])
+    p1 = StagedProducer(link, outbox_database, batch_size=3, claim="lease", lease=60)
+    p2 = StagedProducer(link, outbox_database, batch_size=3, claim="lease", lease=60)
+
+    first, _ = p1.get_records()
+    second, _ = p2.get_records()
+    assert [m.data["i"] for m in first] == [0, 1, 2]
+    assert [m.data["i"] for m in second] == [3, 4]
+    # The rows stay claimed until they are sent or the lease runs out
+    assert p1.get_records()[0] == []
+
+    # Rows whose lease has run out are claimed again
+    telstar.stage_many([("mytopic", dict(i=5))])
+    expired = StagedProducer(link, outbox_database, batch_size=3, claim="lease", lease=-1)
+    assert [m.data["i"] for m in expired.get_records()[0]] == [5]
+    staged, done = p1.get_records()
+    assert [m.data["i"] for m in staged] == [5]
+    done()
+    assert expired.get_records()[0] == []
+
+
+def test_staged_producer_releases_leases_when_sending_fails(outbox_database, link):
+    telstar.stage_many([("mytopic", dict(i=i)) for i in range(2)])
+    failing = mock.MagicMock()
+    failing.pipeline.return_value.execute.side_effect = redis.exceptions.ConnectionError()
+    with pytest.raises(redis.exceptions.ConnectionError):
+        StagedProducer(failing, outbox_database, claim="lease", lease=60).run_once()
+
+    staged, _ = StagedProducer(link, outbox_database, claim="lease", lease=60).get_records()
+    assert [m.data["i"] for m in staged] == [0, 1]
+
+
+def test_staged_producers_claim_rows_concurrently(outbox_database):
+    uids = telstar.stage_many([("mytopic", dict(i=i)) for i in range(6)])
+    links = [mock.MagicMock() for _ in range(2)]
+    for link in links:
+        # Sending takes a while, during which the other producer pulls
+        link.pipeline.return_value.execute.side_effect = lambda: time.sleep(0.05)
+    producers = [StagedProducer(link, outbox_database, batch_size=2, max_batch_size=2, claim="lease", lease=60) for link in links]
+
+    errors = []
+
+    def run(producer):
+        try:
+            for _ in range(3):
+                with producer.context_callable():
+                    producer.run_once()
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run, args=(producer,)) for producer in producers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    sent = [[call.args[1][Message.IDFieldName] for call in link.pipeline.return_value.xadd.call_args_list] for link in links]
+    assert all(sent)
+    assert sorted(sent[0] + sent[1]) == sorted(map(str, uids))
+    assert tlconfig.staging.repository.unsent().count() == 0
+
+
+@pytest.mark.only_sqla
+def test_supports_skip_locked_connects_first():
+    session = mock.Mock()
+    session.get_bind.return_value.dialect.name = "mysql"
+    session.get_bind.return_value.dialect.server_version_info = None
+    session.connection.return_value.dialect.server_version_info = (8, 0, 36)
+    repository = StagedMessageSqlAlchemy.__class__()
+    repository.setup(session)
+    assert repository.supports_skip_locked()
+    session.connection.assert_called_once_with()
+
+
 @pytest.mark.only_sqla
 def test_staged_producer_context_callable(session_maker, link):
     session = session_maker(autocommit=True)
@@ -468,6 +1077,41 @@ def test_app_consumer_ack_invalid(db_session, reallink, mocker, msg_schema):
     ack.assert_called_once()
 
 
+@pytest.mark.integration
+def test_producer_sequence(db_session, reallink):
+    for i in range(3):
+        telstar.stage(f"mytopic{i % 2}", dict(i=i))
+    producer = StagedProducer(reallink, db_session, batch_size=10)
+    producer.run_once()
+
+    records = [r for stream in ("mytopic0", "mytopic1") for _, r in reallink.xrange(f"telstar:stream:{stream}")]
+    assert sorted(int(r[Message.SequenceFieldName]) for r in records) == [1, 2, 3]
+    assert {r[Message.ProducerFieldName] for r in records} == {producer.name.encode("ascii")}
+    assert producer.sequence == 3
+
+
+@pytest.mark.integration
+def test_app_consumer_reuses_schema(db_session, reallink, mocker, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1")
+    init = mocker.spy(msg_schema, "__init__")
+
+    @app.consumer("group", "mytopic", schema=msg_schema, strict=False)
+    def callback(data: dict):
+        pass
+
+    telstar.stage("mytopic", dict(name="1", email="a@b.com"))
+    telstar.stage("mytopic", dict(name="2", email="a@b.com"))
+    telstar.stage("mytopic", dict(name="3", email="invalid"))
+    StagedProducer(reallink, db_session, batch_size=10).run_once()
+
+    app.run_once()
+    assert init.call_count == 1
+    stats = app.metrics()["validation"]["group.callback"]
+    assert stats["loaded"] == 3
+    assert stats["invalid"] == 1
+    assert stats["time_ms"] > 0
+
+
 @pytest.mark.integration
 def test_app_consumer_do_not_ack_invalid(db_session, reallink, mocker, msg_schema):
     app = telstar.app(reallink, consumer_name="c1")
@@ -504,6 +1148,74 @@ def test_app_consumer_full_message(db_session, reallink, mocker, msg_schema):
     assert isinstance(msg, Message)
 
 
+@pytest.mark.integration
+def test_app_consumer_mixed_codecs(db_session, reallink, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1")
+    m = mock.Mock()
+
+    @app.consumer("group", "mytopic", schema=msg_schema)
+    def callback(data: dict):
+        m(data["name"])
+
+    telstar.stage("mytopic", dict(name="1", email="a@b.com"))
+    StagedProducer(reallink, db_session, codec=codecs.ORJSONCodec()).run_once()
+    telstar.stage("mytopic", dict(name="2" * 100, email="a@b.com"))
+    StagedProducer(reallink, db_session, codec=codecs.Compressed(codecs.JSONCodec(), threshold=64)).run_once()
+    reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: '{"name": "3"}'})
+
+    app.run_once()
+    assert [c[0][0] for c in m.call_args_list] == ["1", "2" * 100, "3"]
+    content_types = [r[Message.ContentTypeFieldName] for _, r in reallink.xrange("telstar:stream:mytopic", count=2)]
+    assert content_types == [b"json", b"json+zlib"]
+
+
+def test_codecs():
+    data = dict(uid=uuid.UUID("752884c3-f728-4cf1-9d3b-9940373685f4"), at=datetime(2020, 1, 1, tzinfo=timezone.utc))
+    expected = dict(uid="752884c3-f728-4cf1-9d3b-9940373685f4", at="2020-01-01T00:00:00+00:00")
+    codec = codecs.Compressed(codecs.JSONCodec(), threshold=10)
+    content_type, raw = codec.encode(data)
+    assert content_type == b"json+zlib"
+    assert codecs.decode(content_type, raw) == expected
+    assert codecs.decode(None, b'{"a": 1}') == {"a": 1}
+    with pytest.raises(codecs.CodecError):
+        codecs.decode(b"yaml", b"a: 1")
+    with pytest.raises(codecs.CodecError):
+        codecs.decode(b"json+zlib", b"not compressed")
+    with pytest.raises(codecs.CodecError):
+        codecs.decode(b"json", b"{not json")
+    if codecs.msgpack is not None:
+        assert codecs.decode(*codecs.MsgpackCodec().encode(data)) == expected
+
+
+def test_codecs_decode_json_like_the_default_producer():
+    content_type, raw = codecs.default_codec.encode(dict(big=2**70, nan=float("nan")))
+    decoded = codecs.decode(content_type, raw)
+    assert decoded["big"] == 2**70
+    assert math.isnan(decoded["nan"])
+
+
+@pytest.mark.integration
+def test_app_atomic_ack(db_session, reallink, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1", atomic_ack=True, batch_ack=True)
+    m = mock.Mock()
+
+    @app.consumer("group", "mytopic", schema=msg_schema)
+    def callback(data: dict):
+        m()
+
+    telstar.stage("mytopic", dict(name="1", email="a@b.com"))
+    telstar.stage("mytopic", dict(name="2", email="a@b.com"))
+    StagedProducer(reallink, db_session, batch_size=10).run_once()
+
+    app.run_once()
+    app.run_once()
+    assert m.call_count == 2
+    assert reallink.xpending("telstar:stream:mytopic", "group")["pending"] == 0
+    assert len(reallink.keys("telstar:seen:mytopic:group:*")) == 2
+    [last] = reallink.xrevrange("telstar:stream:mytopic", count=1)
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:group:c1") == last[0]
+
+
 @pytest.mark.integration
 def test_consumer_once(db_session, reallink):
     result = list()
@@ -531,6 +1243,541 @@ def test_consumer_once(db_session, reallink):
     assert result == list(range(10))
 
 
+@pytest.mark.integration
+def test_consumer_once_in_pages(db_session, reallink):
+    result = list()
+    for i in range(10):
+        telstar.stage("mytopic", dict(i=i))
+
+    def callback(c, msg: Message, done):
+        result.append(int(msg.data["i"]))
+        done()
+
+    StagedProducer(reallink, db_session, batch_size=100).run_once()
+
+    m = MultiConsumeOnce(reallink, "mytest", {"mytopic": callback})
+    m.catchup_page_size = 3
+    assert m.run() == 10
+    assert result == list(range(10))
+
+
+@pytest.mark.integration
+def test_consumer_autoclaim_from_the_dead(db_session, reallink):
+    if tuple(map(int, reallink.info()["redis_version"].split(".")[:2])) < (6, 2):
+        pytest.skip("XAUTOCLAIM requires redis >= 6.2")
+    for i in range(5):
+        telstar.stage("mytopic", dict(i=i))
+    StagedProducer(reallink, db_session, batch_size=100).run_once()
+
+    dead = Consumer(reallink, "mygroup", "dead", "mytopic", lambda c, msg, done: None)
+    dead.run_once()
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 5
+
+    result = list()
+
+    def callback(c, msg: Message, done):
+        result.append(int(msg.data["i"]))
+        done()
+
+    alive = Consumer(reallink, "mygroup", "alive", "mytopic", callback)
+    alive.autoclaim, alive.claim_page_size, alive.claim_the_dead_after = True, 2, 0
+    alive.run_once()
+    assert result == list(range(5))
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 0
+
+
+@pytest.mark.integration
+def test_consumer_process_claimed_from_the_dead(db_session, reallink):
+    for i in range(5):
+        telstar.stage("mytopic", dict(i=i))
+    StagedProducer(reallink, db_session, batch_size=100).run_once()
+
+    dead = Consumer(reallink, "mygroup", "dead", "mytopic", lambda c, msg, done: None)
+    dead.run_once()
+
+    result = list()
+
+    def callback(c, msg: Message, done):
+        result.append(int(msg.data["i"]))
+        done()
+
+    alive = MultiConsumer(reallink, "mygroup", "alive", {"mytopic": callback},
+                          claim_the_dead_after=0, process_claimed=True, claim_page_size=2)
+    alive.run_once()
+    assert result == list(range(5))
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 0
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("store", [SeenKeys(), SeenBuckets(), SeenBloom(capacity=1000)])
+def test_seen_stores(reallink, store):
+    seen, unseen = str(uuid.uuid4()), str(uuid.uuid4())
+    pipe = reallink.pipeline()
+    store.mark(pipe, "mygroup", "mytopic", seen)
+    pipe.execute()
+    assert store.seen(reallink, "mygroup", [("mytopic", seen), ("mytopic", unseen), ("othertopic", seen)]) == [True, False, False]
+    assert store.seen(reallink, "othergroup", [("mytopic", seen)]) == [False]
+
+
+@pytest.mark.integration
+def test_seen_store_legacy_keys_and_migration(reallink):
+    uid = str(uuid.uuid4())
+    reallink.set(f"telstar:seen:mytopic:mygroup:{uid}", 1, ex=14 * 24 * 60 * 60)
+
+    assert SeenBuckets().seen(reallink, "mygroup", [("mytopic", uid)]) == [False]
+    assert SeenBuckets(legacy=True).seen(reallink, "mygroup", [("mytopic", uid)]) == [True]
+
+    assert migrate_seen_keys(reallink, SeenBuckets(), "mytopic", "mygroup", delete=True) == 1
+    assert reallink.keys("telstar:seen:*") == []
+    assert SeenBuckets().seen(reallink, "mygroup", [("mytopic", uid)]) == [True]
+
+
+@pytest.mark.integration
+def test_app_seen_store(db_session, reallink, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1", seen_store=SeenBuckets())
+    m = mock.Mock()
+
+    @app.consumer("group", "mytopic", schema=msg_schema)
+    def callback(data: dict):
+        m()
+
+    uid = uuid.uuid4()
+    record = {Message.IDFieldName: str(uid), Message.DataFieldName: '{"name": "1", "email": "a@b.com"}'}
+    reallink.xadd("telstar:stream:mytopic", record)
+    reallink.xadd("telstar:stream:mytopic", record)
+
+    app.run_once()
+    app.run_once()
+    assert m.call_count == 1
+    assert reallink.keys("telstar:seen:*") == []
+    assert reallink.xpending("telstar:stream:mytopic", "group")["pending"] == 0
+
+
+def test_batch_progress():
+    progress = BatchProgress([
+        [b"telstar:stream:a", [[b"1-0", {}], [b"2-0", {}], [b"3-0", {}]]],
+        [b"telstar:stream:b", [[b"1-1", {}]]],
+    ])
+    assert progress.checkpoints() == {}
+    progress.complete("telstar:stream:a", b"2-0")
+    progress.complete("telstar:stream:b", "1-1")
+    assert progress.checkpoints() == {"telstar:stream:b": StreamID(1, 1)}
+    progress.complete(b"telstar:stream:a", "1-0")
+    assert progress.checkpoints() == {"telstar:stream:a": StreamID(2, 0), "telstar:stream:b": StreamID(1, 1)}
+
+
+@pytest.mark.integration
+def test_consumer_worker_pool_keeps_partition_order(reallink):
+    lock = threading.Lock()
+    in_flight, most_in_flight = 0, 0
+    processed = {"a": [], "b": [], "c": []}
+
+    def callback(c, msg: Message, done):
+        nonlocal in_flight, most_in_flight
+        with lock:
+            in_flight += 1
+            most_in_flight = max(most_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        processed[msg.data["key"]].append(msg.data["i"])
+        done()
+
+    for i in range(15):
+        last = reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()),
+                                                        Message.DataFieldName: f'{{"key": "{"abc"[i % 3]}", "i": {i}}}'})
+    c = MultiConsumer(reallink, "mygroup", "myname", {"mytopic": callback}, max_workers=3, partition_key="key", block=10)
+    c.run_once()
+
+    assert processed == {"a": [0, 3, 6, 9, 12], "b": [1, 4, 7, 10, 13], "c": [2, 5, 8, 11, 14]}
+    assert most_in_flight > 1
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 0
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname") == last
+
+
+@pytest.mark.integration
+def test_consumer_worker_pool_undecodable_partition(reallink):
+    handled, processed = mock.Mock(), list()
+
+    def callback(c, msg: Message, done):
+        processed.append(msg.data)
+        done()
+
+    def handler(exc, ack, record):
+        handled(record)
+        ack()
+
+    reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: "not json"})
+    reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: "[1, 2]"})
+    reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: '{"k": 1}'})
+    c = MultiConsumer(reallink, "mygroup", "myname", {"mytopic": callback}, max_workers=2, partition_key="k", block=10,
+                      error_handlers={ValueError: handler})
+    c.run_once()
+
+    assert handled.call_count == 1
+    assert sorted(map(str, processed)) == ["[1, 2]", "{'k': 1}"]
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 0
+
+
+@pytest.mark.integration
+def test_consumer_worker_pool_checkpoint_is_contiguous(reallink):
+    def callback(c, msg: Message, done):
+        if msg.data["i"] != 2:
+            done()
+
+    ids = [reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: f'{{"i": {i}}}'})
+           for i in range(5)]
+    c = MultiConsumer(reallink, "mygroup", "myname", {"mytopic": callback}, max_workers=4, block=10)
+    c.run_once()
+
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname") == ids[1]
+    assert c.get_last_seen_id("telstar:stream:mytopic") == StreamID.parse(ids[1])
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 1
+
+
+def test_prefetcher_drops_stale_responses():
+    def reader():
+        responses = iter([[("mytopic", [1])], [("mytopic", [2, 3])]])
+        return lambda: next(responses, None) or time.sleep(0.01) or []
+
+    prefetcher = Prefetcher(reader(), 2)
+    prefetcher.start()
+    assert prefetcher.get(timeout=1, max_age=10) == [("mytopic", [1])]
+    prefetcher.stop()
+
+    prefetcher = Prefetcher(reader(), 2)
+    prefetcher.start()
+    time.sleep(0.1)
+    assert prefetcher.get(timeout=0, max_age=0.05) == []
+    assert prefetcher.queue.qsize() == 0
+    prefetcher.stop()
+
+
+def test_consumer_prefetch_applies_backpressure(link: redis.Redis):
+    callback = mock.Mock()
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [["1-0", {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": "{}"}]]
+    ]]
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": callback}, prefetch=2)
+    c.transfer_and_process_stream_history = lambda *a, **kw: None
+    c.run_once()
+    time.sleep(0.3)
+
+    assert callback.call_count == 1
+    assert c._prefetcher.queue.qsize() == 2
+    # One batch has been processed, two are waiting and one more waits for space in the queue
+    assert link.xreadgroup.call_count == 4
+    c.run_once()
+    assert callback.call_count == 2
+    c.close()
+
+
+def test_consumer_prefetch_raises_read_errors(link: redis.Redis):
+    link.xreadgroup.side_effect = redis.exceptions.ConnectionError("gone")
+    c = MultiConsumer(link, "mygroup", "myname", {"mytopic": mock.Mock()}, prefetch=1)
+    c.transfer_and_process_stream_history = lambda *a, **kw: None
+    with pytest.raises(redis.exceptions.ConnectionError):
+        c.run_once()
+    assert c._prefetcher is None
+
+
+@pytest.mark.integration
+def test_consumer_prefetch(reallink):
+    processed = []
+
+    def callback(c, msg: Message, done):
+        processed.append(msg.data["i"])
+        done()
+
+    c = MultiConsumer(reallink, "mygroup", "myname", {"mytopic": callback}, prefetch=1, catchup_page_size=2, block=50)
+    c.run_once()
+    for i in range(5):
+        reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: f'{{"i": {i}}}'})
+    for _ in range(50):
+        if len(processed) == 5:
+            break
+        c.run_once()
+    c.close()
+
+    assert processed == list(range(5))
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 0
+
+
+@pytest.mark.integration
+def test_consumer_batch_processor_waits_for_batch(reallink):
+    batches = []
+
+    def process(c, msgs: List[Message]):
+        batches.append([msg.data["i"] for msg in msgs])
+        return [msg.data["i"] != 1 for msg in msgs]
+
+    processor = BatchProcessor(process, max_batch=3, max_wait_ms=60 * 1000)
+    c = MultiConsumer(reallink, "batchgroup", "myname", {"mytopic": processor}, block=10)
+    ids = [reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: f'{{"i": {i}}}'})
+           for i in range(2)]
+    c.run_once()
+    assert batches == []
+
+    ids.append(reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: '{"i": 2}'}))
+    c.run_once()
+    assert batches == [[0, 1, 2]]
+    pending = reallink.xpending_range("telstar:stream:mytopic", "batchgroup", "-", "+", 10)
+    assert [p["message_id"] for p in pending] == [ids[1]]
+    # The checkpoint stays in front of the failed message which is read again when catching up
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:batchgroup:myname") == ids[0]
+
+
+@pytest.mark.integration
+def test_app_batch_consumer(db_session, reallink, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1")
+    batches = []
+
+    @app.batch_consumer("group", "mytopic", schema=msg_schema, max_batch=10)
+    def callback(records: list):
+        batches.append([r["name"] for r in records])
+        return [r["name"] != "2" for r in records]
+
+    for name, email in [("1", "a@b.com"), ("2", "a@b.com"), ("3", "invalid"), ("4", "a@b.com")]:
+        telstar.stage("mytopic", dict(name=name, email=email))
+    StagedProducer(reallink, db_session, batch_size=10).run_once()
+
+    app.run_once()
+    assert batches == [["1", "2", "4"]]
+    assert reallink.xpending("telstar:stream:mytopic", "group")["pending"] == 2
+    assert len(reallink.keys("telstar:seen:mytopic:group:*")) == 2
+    assert app.metrics()["validation"]["group.callback"]["invalid"] == 1
+
+
+def test_process_consumer_replicas(link: redis.Redis):
+    def callback(c, msg: Message, done):
+        done()
+
+    link.get.return_value = None
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [["1-0", {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": "{}"}]]
+    ]]
+    c = ProcessMultiConsumer(link, "c1", {"mygroup": {"mytopic": callback}, "othergroup": {"mytopic": callback}},
+                             replicas={"mygroup": 2})
+    c.run_once()
+
+    status = c.status()
+    assert sorted(w["consumer"] for w in status["workers"]) == ["c1", "c1-0", "c1-1"]
+    assert all(w["processed"] > 0 for w in status["workers"])
+    assert status["processed"] == sum(w["processed"] for w in status["workers"])
+    assert status["alive"] == 0
+
+
+def test_process_consumer_restarts_crashed_workers(link: redis.Redis):
+    def callback(c, msg: Message, done):
+        raise ValueError("boom")
+
+    link.get.return_value = None
+    link.xreadgroup.return_value = [[
+        b"telstar:stream:mytopic", [["1-0", {b'message_id': str(uuid.uuid4()).encode("ascii"), b"data": "{}"}]]
+    ]]
+    c = ProcessMultiConsumer(link, "c1", {"mygroup": {"mytopic": callback}}, restart_backoff=0)
+    with pytest.raises(RuntimeError, match="ValueError"):
+        c.run_once()
+
+    [worker] = c.workers.values()
+    c.supervise(timeout=0.01)
+    assert worker.failures == 1 and worker.restart_at is not None
+    c.supervise(timeout=0.01)
+    assert worker.restarts == 1
+    c.stop()
+    assert c.status()["restarts"] == 1
+
+
+def test_threaded_consumer_saves_checkpoints_when_stopped(link: redis.Redis):
+    pipeline = mock.MagicMock(spec=redis.client.Pipeline)()
+    link.pipeline.return_value = pipeline
+    config = {"mygroup1": {"mytopic": mock.Mock()}, "mygroup2": {"mytopic": mock.Mock()}}
+    c = ThreadedMultiConsumer(link, "c1", config, checkpoint_interval=60 * 1000)
+    for consumer in c.consumers:
+        consumer._save_checkpoints({"telstar:stream:mytopic": StreamID(2, 0)})
+    pipeline.set.assert_not_called()
+
+    c._run_threaded = mock.Mock(side_effect=SystemExit(0))
+    handler = signal.getsignal(signal.SIGTERM)
+    try:
+        with pytest.raises(SystemExit):
+            c.run()
+        assert signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+    assert sorted(call.args for call in pipeline.set.call_args_list) == [
+        ("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup1:c1", b"2-0"),
+        ("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup2:c1", b"2-0"),
+    ]
+
+
+@pytest.mark.integration
+def test_process_consumer_saves_checkpoints_when_stopped(reallink):
+    for i in range(3):
+        last = reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: "{}"})
+    c = ProcessMultiConsumer(reallink, "c1", {"mygroup": {"mytopic": lambda c, msg, done: done()}},
+                             checkpoint_interval=60 * 1000, block=10)
+    [worker] = c.workers.values()
+    c._start(worker)
+    deadline = time.monotonic() + 10
+    while c.status()["processed"] < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:c1") is None
+    c.stop()
+    assert worker.process.exitcode == 0
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:c1") == last
+
+
+@pytest.mark.integration
+def test_app_process_consumer(db_session, reallink, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1", consumer_cls=ProcessMultiConsumer, replicas=2)
+
+    @app.consumer("group", "mytopic", schema=msg_schema)
+    def callback(data: dict):
+        pass
+
+    for i in range(10):
+        telstar.stage("mytopic", dict(name=str(i), email="a@b.com"))
+    StagedProducer(reallink, db_session, batch_size=10).run_once()
+
+    app.run_once()
+    assert len(reallink.keys("telstar:seen:mytopic:group:*")) == 10
+    assert reallink.xpending("telstar:stream:mytopic", "group")["pending"] == 0
+
+
+@pytest.mark.integration
+def test_app_async(db_session, reallink, asynclink, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1")
+    m = mock.Mock()
+
+    @app.consumer("group", ["mytopic", "mytopic2"], schema=msg_schema)
+    async def callback(data: dict):
+        await asyncio.sleep(0)
+        m("group")
+
+    @app.consumer("group2", "mytopic", schema=msg_schema)
+    async def callback2(msg: Message):
+        m("group2")
+
+    uid = uuid.uuid4()
+    record = {Message.IDFieldName: str(uid), Message.DataFieldName: '{"name": "1", "email": "a@b.com"}'}
+    reallink.xadd("telstar:stream:mytopic", record)
+    reallink.xadd("telstar:stream:mytopic", record)
+    telstar.stage("mytopic2", dict(name="1", email="a@b.com"))
+    StagedProducer(reallink, db_session).run_once()
+
+    run_async(app.run_once_async(asynclink))
+    assert sorted(c.args[0] for c in m.call_args_list) == ["group", "group", "group2"]
+    assert reallink.xpending("telstar:stream:mytopic", "group")["pending"] == 0
+    assert reallink.xpending("telstar:stream:mytopic", "group2")["pending"] == 0
+    assert reallink.get(f"telstar:seen:mytopic:group:{uid}")
+
+
+def test_app_async_consumer_needs_async_engine(link: redis.Redis, msg_schema):
+    app = telstar.app(link, consumer_name="c1")
+
+    @app.consumer("group", "mytopic", schema=msg_schema)
+    async def callback(data: dict):
+        pass
+
+    with pytest.raises(ValueError, match="start_async"):
+        app.get_consumer()
+    with pytest.raises(ValueError, match="start_async"):
+        ProcessMultiConsumer(link, "c1", app.config)
+
+
+@pytest.mark.integration
+def test_app_async_errorhandler(db_session, reallink, asynclink, msg_schema):
+    app = telstar.app(reallink, consumer_name="c1")
+    m = mock.Mock()
+
+    @app.consumer("group", "mytopic", schema=msg_schema, strict=True)
+    async def callback(data: dict):
+        pass
+
+    @app.errorhandler(ValidationError)
+    async def handler(exc, ack, record):
+        m(record)
+        await ack()
+
+    telstar.stage("mytopic", dict(name="1", email="invalid"))
+    StagedProducer(reallink, db_session).run_once()
+
+    run_async(app.run_once_async(asynclink))
+    assert m.call_count == 1
+    assert reallink.xpending("telstar:stream:mytopic", "group")["pending"] == 0
+
+
+@pytest.mark.integration
+def test_async_consumer_in_flight(reallink, asynclink):
+    in_flight, most_in_flight, processed = 0, 0, []
+
+    async def callback(c, msg: Message, done):
+        nonlocal in_flight, most_in_flight
+        in_flight += 1
+        most_in_flight = max(most_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        processed.append(msg.data["i"])
+        await done()
+
+    last = None
+    for i in range(10):
+        last = reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: f'{{"i": {i}}}'})
+
+    c = AsyncMultiConsumer(asynclink, "mygroup", "myname", {"mytopic": callback}, max_in_flight=3, block=10)
+    run_async(c.run_once())
+    assert sorted(processed) == list(range(10))
+    assert most_in_flight == 3
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 0
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname") == last
+
+
+@pytest.mark.integration
+def test_async_consumer_in_flight_checkpoint(reallink, asynclink):
+    async def callback(c, msg: Message, done):
+        # The first message is still pending while the others are done
+        if msg.data["i"] != 0:
+            await done()
+
+    for i in range(5):
+        reallink.xadd("telstar:stream:mytopic", {Message.IDFieldName: str(uuid.uuid4()), Message.DataFieldName: f'{{"i": {i}}}'})
+
+    c = AsyncMultiConsumer(asynclink, "mygroup", "myname", {"mytopic": callback}, max_in_flight=3, block=10)
+    run_async(c.run_once())
+    assert reallink.xpending("telstar:stream:mytopic", "mygroup")["pending"] == 1
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname") is None
+
+
+@pytest.mark.parametrize("options, connection, attribute, value", [
+    (dict(unix_socket_path="/tmp/redis.sock"), "UnixDomainSocketConnection", "path", "/tmp/redis.sock"),
+    (dict(ssl=True, ssl_keyfile="client.key"), "SSLConnection", "keyfile", "client.key"),
+    (dict(host="redis.local", db=3), "Connection", "host", "redis.local"),
+])
+def test_async_link_keeps_the_connection_type(options, connection, attribute, value):
+    conn = async_link(redis.Redis(**options)).connection_pool.make_connection()
+    assert conn.__class__ is getattr(redis.asyncio.connection, connection)
+    assert getattr(conn, attribute) == value
+
+
+@pytest.mark.integration
+def test_async_consumer_checkpoints_only_move_forward(reallink, asynclink):
+    c = AsyncMultiConsumer(asynclink, "mygroup", "myname", {"mytopic": mock.Mock()})
+
+    async def acknowledge():
+        await c.acknowledge(Message("mytopic", uuid.uuid4(), {}), b"5-0")
+        await c.acknowledge(Message("mytopic", uuid.uuid4(), {}), b"3-0")
+        await c._bare_ack("telstar:stream:mytopic", b"1-0")
+
+    run_async(acknowledge())
+    assert reallink.get("telstar:checkpoint:telstar:stream:mytopic:cg:mygroup:myname") == b"5-0"
+
+
+def test_async_consumer_rejects_unsupported_options(link):
+    with pytest.raises(ValueError):
+        AsyncMultiConsumer(link, "mygroup", "myname", {"mytopic": None}, batch_ack=True)
+
+
 @pytest.mark.integration
 def test_admin_basics(reallink, db_session, msg_schema):
     app = telstar.app(reallink, consumer_name="c1")